@@ -1,18 +1,32 @@
+import assets
+import deadlines
 import dotenv
+import gcs
 import gemini
+import person_photo
+import profiling
+import imagen
 import json
+import metrics
+import page_cache
+import retail
+import tracing
+import vto_cache
+import vto_warmer
+import warmup
 import os
 import time
 import uuid
-from flask import Flask, render_template, jsonify, request, send_file, session, redirect, url_for
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, jsonify, request, send_file, session, redirect, url_for, abort, g, has_request_context
 from virtual_try_on import generate_virtual_try_on_image
-from veo import generate_video_from_gcs
+from veo import generate_video_for_image
 from imagen import rewrite_prompt, generate_image
-from google.cloud import storage
+import contextlib
 import io
+import mimetypes
 from urllib.parse import urlparse
 from google.cloud import retail_v2
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 import threading
 
@@ -23,16 +37,192 @@ dotenv.load_dotenv()
 
 UPLOAD_FOLDER = 'static/uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
 VAIS_GCP_PROJECT_NUMBER = os.environ.get("VAIS_GCP_PROJECT_NUMBER")
 VAIS_GCP_LOCATION = os.environ.get("VAIS_GCP_LOCATION")
 VAIS_CATALOG_ID = os.environ.get("VAIS_CATALOG_ID")
 
+CATALOG_PATH = 'products.json'
+
+# Parsed products.json, reloaded whenever the file changes on disk
+_catalog = {'mtime': None, 'version': None, 'products': [], 'by_id': {}}
+_catalog_lock = threading.Lock()
+
+def load_catalog():
+    """Returns the curated products; treat the list as read-only."""
+    return _current_catalog()['products']
+
+def catalog_product(product_id):
+    """Returns the curated product with this numeric ID, or None."""
+    return _current_catalog()['by_id'].get(product_id)
+
+def catalog_version():
+    """Returns a hash of products.json that changes whenever the catalog does."""
+    return _current_catalog()['version']
+
+def _current_catalog():
+    mtime = os.stat(CATALOG_PATH).st_mtime_ns
+    with _catalog_lock:
+        if _catalog['mtime'] != mtime:
+            with open(CATALOG_PATH, 'rb') as f:
+                data = f.read()
+            products = json.loads(data)
+            _catalog.update(
+                mtime=mtime,
+                version=gcs.content_hash(data)[:16],
+                products=products,
+                by_id={p['id']: p for p in products},
+            )
+            # Pages rendered from the previous catalog are stale
+            page_cache.clear()
+        return _catalog
+
+def fallback_products(query, page_size):
+    """Serves curated products from products.json while the Retail API is unavailable."""
+    terms = query.lower().split()
+    products = []
+    for p in load_catalog():
+        text = f"{p.get('name', '')} {p.get('category', '')}".lower()
+        if all(term in text for term in terms):
+            products.append({
+                'id': p['id'],
+                'name': p['name'],
+                'image_urls': { 'small': p['image_urls']['small'], 'large': p['image_urls']['large'] },
+                'price': p.get('price')
+            })
+    return products[:page_size]
+
+# Recent product search responses, keyed by (query, page size, page token)
+search_cache = OrderedDict()
+search_cache_lock = threading.Lock()
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 300))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 256))
+
+# The products page searches for this until the user types a query
+DEFAULT_SEARCH_QUERY = 'Basic Tee'
+DEFAULT_SEARCH_PAGE_SIZE = 10
+
 # In-memory store for video generation status
 video_status = {}
 
+# In-memory store for batch try-on status, keyed by batch ID
+batch_status = {}
+BATCH_TRY_ON_WORKERS = int(os.environ.get("BATCH_TRY_ON_WORKERS", 4))
+BATCH_TRY_ON_MAX_ITEMS = int(os.environ.get("BATCH_TRY_ON_MAX_ITEMS", 50))
+BATCH_TRY_ON_ITEM_BUDGET = float(os.environ.get("BATCH_TRY_ON_ITEM_BUDGET", 90))
+# Shared by every batch, so concurrent batches cannot multiply model load
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_TRY_ON_WORKERS, thread_name_prefix="batch-try-on")
+
+# Seconds finished batch and refinement statuses stay pollable
+STATUS_TTL = float(os.environ.get("TRY_ON_STATUS_TTL", 3600))
+
+def evict_finished(statuses):
+    """Drops entries that finished more than STATUS_TTL seconds ago from a status store."""
+    cutoff = time.time() - STATUS_TTL
+    for key, status in list(statuses.items()):
+        if status.get('finished_at', cutoff) < cutoff:
+            statuses.pop(key, None)
+
+# House model photos offered on the try-on page
+HOUSE_MODEL_URLS = [
+    "https://storage.googleapis.com/ksaw_thelook_ecommerce/static/model_1.jpg",
+    "https://storage.googleapis.com/ksaw_thelook_ecommerce/static/model_2.jpg",
+    "https://storage.googleapis.com/ksaw_thelook_ecommerce/static/model_3.jpg",
+    "https://storage.googleapis.com/ksaw_thelook_ecommerce/static/model_4.jpg",
+]
+
+# Number of try-on renders in progress for users (requests, refinement and
+# batch items); the warmer yields to them
+live_try_ons = 0
+live_try_ons_lock = threading.Lock()
+
+# In-memory store for progressive try-on refinement status, keyed by generation ID
+refine_status = {}
+REFINE_BUDGET = float(os.environ.get("VTO_REFINE_BUDGET", 90))
+
+# Generated images are served as static files, so they must be cached under static/
+if os.path.relpath(os.path.abspath(gemini.IMAGE_CACHE_DIR), app.static_folder).startswith(os.pardir):
+    raise RuntimeError(f"GEMINI_IMAGE_CACHE_DIR must be inside {app.static_folder}, got {gemini.IMAGE_CACHE_DIR}")
+
+# Re-queue any uploads a previous process staged but never finished
+gcs.resume_pending()
+
+# Fingerprint and precompress static assets; only changed files are rewritten
+assets.build()
+
+@app.context_processor
+def asset_helpers():
+    return {'asset_url': asset_url}
+
+def asset_url(filename):
+    """Like url_for('static', filename=...), but returns the fingerprinted asset URL when there is one."""
+    name = assets.fingerprinted(filename)
+    if name is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=name)
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """Serves a fingerprinted asset, precompressed when the client accepts it."""
+    resolved = assets.resolve(filename, request.headers.get('Accept-Encoding', ''))
+    if resolved is None:
+        abort(404)
+    path, encoding = resolved
+    # conditional=True handles If-None-Match, If-Modified-Since and Range
+    response = send_file(os.path.abspath(path), mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+    response.headers['Cache-Control'] = assets.CACHE_CONTROL
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.before_request
+def start_request_span():
+    # Static files, probes and the trace viewer itself are not worth tracing
+    if request.endpoint in (None, 'static', 'asset', 'debug_traces', 'healthz', 'readyz'):
+        return
+    g.request_span = tracing.start_span(f"{request.method} {request.url_rule}", path=request.path)
+
+@app.teardown_request
+def finish_request_span(error=None):
+    request_span = g.pop('request_span', None)
+    if request_span:
+        tracing.finish_span(*request_span, error=error)
+
+def profile_token():
+    return request.headers.get(profiling.PROFILE_HEADER) or request.args.get(profiling.PROFILE_PARAM)
+
+@app.before_request
+def begin_request_profile():
+    # Opt-in per request with a token signed for its path
+    if profiling.is_authorized(request.path, profile_token()):
+        g.profiler = profiling.start_request_profile()
+
+@app.after_request
+def end_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler:
+        response.headers['X-Profile-Id'] = profiling.finish_request_profile(profiler, request.endpoint or 'request')
+    return response
+
+@app.teardown_request
+def discard_request_profile(error=None):
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable()
+
+@app.errorhandler(deadlines.DeadlineExceeded)
+def deadline_exceeded(e):
+    if request.path.startswith('/api/'):
+        return jsonify({'error': str(e)}), 504
+    return "Request timed out", 504
+
 def convert_to_gs_uri(uri: str) -> str:
-    """Converts a public GCS URL to a gs:// URI."""
+    """
+    Converts a public GCS URL or staged media URL to a gs:// URI.
+
+    Absolute media URLs are only recognized on this app's host, so call
+    this within the request that supplied the URI.
+    """
     if uri.startswith("gs://"):
         return uri
     if uri.startswith("https://storage.googleapis.com/"):
@@ -40,31 +230,56 @@ def convert_to_gs_uri(uri: str) -> str:
         # The path will be /<bucket-name>/<object-path>
         # We need to remove the leading '/'
         return f"gs:/{parsed_url.path}"
+    # Media URLs come back absolute (http://host/media/...) when read from the page
+    host = request.host if has_request_context() else None
+    media_blob_name = gcs.blob_name_from_uri(uri, host)
+    if media_blob_name:
+        return gcs.gs_uri(media_blob_name)
     return uri
 
+def cached_page(key, render):
+    """
+    Serves a rendered catalog page from the page cache.
+
+    Responds 304 when the client already has this version, and sends the
+    gzipped body to clients that accept it. Cached pages are the same for
+    every visitor, so nothing from the session may be rendered into them;
+    per-user data has to be fetched separately by the page.
+    """
+    page = page_cache.get_or_render((catalog_version(),) + key, render)
+    # Quality-aware, so "gzip;q=0" counts as refusing gzip
+    use_gzip = request.accept_encodings['gzip'] > 0
+    etag = page.gzipped_etag if use_gzip else page.etag
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(page.gzipped if use_gzip else page.body, mimetype='text/html')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Browsers may keep the page but must revalidate it, which is a cheap 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/')
 def index():
-    with open('products.json') as f:
-        products = json.load(f)
-    
     # Pass a few featured products to the home page
-    return render_template('index.html', products=products[:3])
+    return cached_page(('index.html',), lambda: render_template('index.html', products=load_catalog()[:3]))
 
 @app.route('/products')
 def products():
-    with open('products.json') as f:
-        curated_products = json.load(f)
-    return render_template('products.html', curated_products=curated_products)
+    return cached_page(('products.html',), lambda: render_template('products.html', curated_products=load_catalog()))
 
 @app.route('/product/<path:product_id>')
+@deadlines.budget(3)
 def product(product_id):
     # If the product_id is a full resource name, use it directly.
     # Otherwise, assume it's a numeric ID from the JSON file.
     if 'projects/' in product_id:
         try:
-            product_client = retail_v2.ProductServiceClient()
-            get_request = retail_v2.GetProductRequest(name=product_id)
-            product_data = product_client.get_product(request=get_request)
+            product_data = retail.get_product(product_id)
 
             image_uri = ""
             if product_data.images:
@@ -81,6 +296,9 @@ def product(product_id):
             print(product_details)
             
             return render_template('product.html', product=product_details)
+        except (retail.CircuitOpenError, TimeoutError) as e:
+            print(f"Vertex AI Search unavailable for product {product_id}: {e}")
+            return "Product temporarily unavailable", 503
         except Exception as e:
             print(f"Could not fetch product {product_id} from Vertex AI Search: {e}")
             return "Product not found", 404
@@ -88,19 +306,16 @@ def product(product_id):
         # Fallback to JSON for numeric IDs
         try:
             numeric_id = int(product_id)
-            with open('products.json') as f:
-                products = json.load(f)
-            product = next((p for p in products if p['id'] == numeric_id), None)
-
-            print(product)
+            product = catalog_product(numeric_id)
             if product:
-                return render_template('product.html', product=product)
+                return cached_page(('product.html', numeric_id), lambda: render_template('product.html', product=product))
         except (ValueError, StopIteration):
             pass  # Not a numeric ID or not found in JSON
 
     return "Product not found", 404
 
 @app.route('/api/products')
+@deadlines.budget(2)
 def get_products():
     """
     Fetches products from the Vertex AI Search for commerce (Retail API) catalog.
@@ -112,19 +327,20 @@ def get_products():
     except (TypeError, ValueError):
         page_size = 9
 
+    cache_key = (query, page_size, page_token or '')
+    with search_cache_lock:
+        cached = search_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+        return jsonify(cached[1])
 
     try:
-        # 1. Initialize two clients: one for searching, one for getting product details.
-        search_client = retail_v2.SearchServiceClient()
-        product_client = retail_v2.ProductServiceClient() # <-- Client for getting details
-
-        # 2. Define the placement for the search request
+        # 1. Define the placement for the search request
         placement = (
             f"projects/{VAIS_GCP_PROJECT_NUMBER}/locations/{VAIS_GCP_LOCATION}/"
             f"catalogs/{VAIS_CATALOG_ID}/servingConfigs/default_search"
         )
 
-        # 3. First call: Perform the search to get product IDs (names)
+        # 2. First call: Perform the search to get product IDs (names)
         search_request = retail_v2.SearchRequest(
             placement=placement,
             query=query,
@@ -132,15 +348,15 @@ def get_products():
             page_size=page_size,
             page_token=page_token if page_token else "",
         )
-        search_response = search_client.search(request=search_request)
+        # Searches and product lookups go through the hedging/circuit-breaker layer
+        search_response = retail.search(search_request)
 
         product_names = [result.product.name for result in search_response.results]
 
         # Helper function to fetch details for a single product
         def fetch_product_details(name):
             try:
-                get_request = retail_v2.GetProductRequest(name=name)
-                return product_client.get_product(request=get_request)
+                return retail.get_product(name)
             except Exception as e:
                 print(f"Could not fetch details for {name}: {e}")
                 return None # Return None on error
@@ -149,7 +365,8 @@ def get_products():
         products = []
         with ThreadPoolExecutor() as executor:
             # The map function runs fetch_product_details for every name in the list concurrently
-            full_product_details = executor.map(fetch_product_details, product_names)
+            # Each lookup shares this request's deadline and returns None once it runs out
+            full_product_details = executor.map(deadlines.propagate(fetch_product_details), product_names)
 
             # Process the results as they are completed
             for product_data in full_product_details:
@@ -165,78 +382,114 @@ def get_products():
                         'price': product_data.price_info.price if product_data.price_info else None
                     })
 
-        return jsonify({
+        result = {
             'products': products,
-            'next_page_token': search_response.next_page_token
+            'next_page_token': search_response.next_page_token,
+            # Some lookups failed or ran past the deadline
+            'degraded': len(products) < len(product_names)
+        }
+        if not result['degraded']:
+            with search_cache_lock:
+                search_cache[cache_key] = (time.monotonic(), result)
+                search_cache.move_to_end(cache_key)
+                while len(search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+                    search_cache.popitem(last=False)
+        return jsonify(result)
+
+
+    except (retail.CircuitOpenError, TimeoutError) as e:
+        print(f"Vertex AI Retail API unavailable, serving products.json: {e}")
+        return jsonify({
+            'products': fallback_products(query, page_size),
+            'next_page_token': '',
+            'degraded': True
         })
-
-
     except Exception as e:
         print(f"Error fetching from Vertex AI Retail API: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: only true once warm-up has finished, so cold workers get no traffic."""
+    return jsonify(warmup.status()), 200 if warmup.is_ready() else 503
+
+@app.route('/api/retail-stats')
+def retail_stats():
+    """Reports hedging, timeout and circuit-breaker statistics for the Retail API."""
+    return jsonify(retail.stats())
+
 @app.route('/api/generate-image', methods=['POST'])
+@deadlines.budget(60)
 def generate_image_route():
     data = request.get_json()
     description = data.get('description')
+    quality = data.get('quality', 'full')
     if not description:
         return jsonify({'error': 'Description is required'}), 400
-
-    # Generate a unique filename
-    import time
-    filename = f"generated_{int(time.time())}.png"
-    path = f"static/images/{filename}"
+    if quality not in imagen.QUALITY_TIERS:
+        return jsonify({'error': f'quality must be one of {list(imagen.QUALITY_TIERS)}'}), 400
 
     try:
-        # Generate the image
-        gemini.generate_image(description, path)
-        # Return the path to the image
-        return jsonify({'image_url': f'/{path}'})
+        # Generate the image; it is stored under a hash of the description
+        path = gemini.generate_image(description, quality=quality)
+        # Return the URL of the image, which lives in the static folder
+        filename = os.path.relpath(os.path.abspath(path), app.static_folder).replace(os.sep, '/')
+        return jsonify({'image_url': url_for('static', filename=filename)})
+    except deadlines.DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/imagen-inspire', methods=['POST'])
+@deadlines.budget(60)
 def imagen_route():
     data = request.get_json()
     prompt = data.get('prompt')
+    quality = data.get('quality', 'full')
     if not prompt:
         return jsonify({'error': 'Prompt is required'}), 400
+    if quality not in imagen.QUALITY_TIERS:
+        return jsonify({'error': f'quality must be one of {list(imagen.QUALITY_TIERS)}'}), 400
 
     try:
         # Rewrite the prompt
         rewritten_prompt, title = rewrite_prompt(prompt)
         
         # Generate the image
-        generated_image = generate_image(rewritten_prompt)
-        
-        # Generate a unique filename for the output image
-        output_filename = f"imagen_{int(time.time())}.png"
-        
-        # Upload to GCS
-        storage_client = storage.Client()
-        bucket_name = GCS_BUCKET_NAME
-        if bucket_name.startswith("gs://"):
-            bucket_name = bucket_name[5:]
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(f"inspire/{output_filename}")
+        started = time.monotonic()
+        generated_image = generate_image(rewritten_prompt, quality)
+        metrics.observe(f"imagen.{quality}_latency", time.monotonic() - started)
         
         # Convert PIL image to bytes
         img_byte_arr = io.BytesIO()
         pil_image = generated_image._pil_image if hasattr(generated_image, '_pil_image') else generated_image
-        pil_image.save(img_byte_arr, format='PNG')
+        with tracing.span("encode_png"):
+            pil_image.save(img_byte_arr, format='PNG')
         img_byte_arr = img_byte_arr.getvalue()
         
-        blob.upload_from_string(img_byte_arr, content_type='image/png')
+        # Queue the upload to GCS under the image's content hash;
+        # the staged copy is served until it lands
+        blob_name = gcs.upload_content("inspire", img_byte_arr, ".png", content_type='image/png')
 
-        return jsonify({'image_url': blob.public_url, 'rewritten_prompt': rewritten_prompt, 'title': title})
+        return jsonify({'image_url': gcs.media_url(blob_name), 'rewritten_prompt': rewritten_prompt, 'title': title})
+    except deadlines.DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/virtual-try-on', methods=['POST'])
+@deadlines.budget(90)
 def virtual_try_on_route():
     data = request.get_json()
     person_image_gcs_uri = data.get('person_image_gcs_uri')
     apparel_gcs_uris = data.get('apparel_gcs_uris')
+    # Progressive mode returns a quick preview and refines it in the background
+    progressive = bool(data.get('progressive', False))
 
     if not person_image_gcs_uri:
         return jsonify({'error': 'person_image_gcs_uri is required'}), 400
@@ -248,67 +501,313 @@ def virtual_try_on_route():
     clothing_image_paths = [convert_to_gs_uri(uri) for uri in apparel_gcs_uris]
 
     try:
-        if not person_image_path.startswith("gs://"):
-            # It's a local file path, so we need to upload it to GCS
-            storage_client = storage.Client()
-            bucket_name = GCS_BUCKET_NAME
-            if bucket_name.startswith("gs://"):
-                bucket_name = bucket_name[5:]
-            bucket = storage_client.bucket(bucket_name)
-            
-            filename = f"profile_photos/{int(time.time())}_{os.path.basename(person_image_path)}"
-            blob = bucket.blob(filename)
-            blob.upload_from_filename(person_image_path)
-            person_image_path = f"gs://{bucket.name}/{blob.name}"
-
-        generated_image = generate_virtual_try_on_image(person_image_path, clothing_image_paths)
-        
-        # Generate a unique filename for the output image
-        output_filename = f"vto_{int(time.time())}.png"
-        
-        # Upload to GCS
-        storage_client = storage.Client()
-        bucket_name = GCS_BUCKET_NAME
-        if bucket_name.startswith("gs://"):
-            bucket_name = bucket_name[5:]
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(f"vto/{output_filename}")
-        
-        # Convert PIL image to bytes
-        img_byte_arr = io.BytesIO()
-        pil_image = generated_image._pil_image
-        pil_image.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-        
-        blob.upload_from_string(img_byte_arr, content_type='image/png')
-
-        # Use the public URL as the generation ID
-        generation_id = blob.public_url
-        video_status[generation_id] = {'status': 'processing', 'url': None}
+        started = time.monotonic()
+        result = None
+        if progressive:
+            # Warmed or previously refined results skip the preview entirely
+            result = render_try_on(person_image_path, clothing_image_paths, 'full', cache_only=True)
+            progressive = result is None
+        quality = 'preview' if progressive else 'full'
+        if result is None:
+            result = render_try_on(person_image_path, clothing_image_paths, quality)
+        person_image_path, blob_name, image_hash = result
+        if not progressive:
+            metrics.observe("vto.time_to_final", time.monotonic() - started)
+        image_url = gcs.media_url(blob_name)
+
+        if progressive:
+            # The video is made from the refined image, so both share a new ID
+            generation_id = uuid.uuid4().hex
+            evict_finished(refine_status)
+            refine_status[generation_id] = {'status': 'processing', 'image_url': None}
+            video_status[generation_id] = {'status': 'processing', 'url': None}
+
+            refine_thread = threading.Thread(target=tracing.propagate(refine_try_on), args=(generation_id, person_image_path, clothing_image_paths, started))
+            refine_thread.start()
+        else:
+            # Use the image URL as the generation ID; identical images share one video
+            generation_id = image_url
+            if video_status.get(generation_id, {}).get('status') not in ('processing', 'done'):
+                video_status[generation_id] = {'status': 'processing', 'url': None}
 
-        # Start video generation in a background thread
-        video_thread = threading.Thread(target=generate_and_store_video, args=(generation_id, blob.name))
-        video_thread.start()
+                # Start video generation in a background thread, traced as part of this request
+                video_thread = threading.Thread(target=tracing.propagate(generate_and_store_video), args=(generation_id, blob_name, image_hash))
+                video_thread.start()
 
-        session['vto_image_url'] = blob.public_url
+        session['vto_image_url'] = image_url
         session['vto_person_image'] = person_image_path
         session['vto_clothing_images'] = clothing_image_paths
-        return jsonify({'image_url': blob.public_url, 'generation_id': generation_id})
+        return jsonify({'image_url': image_url, 'generation_id': generation_id, 'refining': progressive})
+    except UploadIncompleteError as e:
+        return jsonify({'error': str(e)}), 503
+    except deadlines.DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def generate_and_store_video(generation_id, image_blob_name):
+class UploadIncompleteError(Exception):
+    """Raised when a try-on input has not made it to GCS."""
+
+@contextlib.contextmanager
+def counting_live_try_on():
+    """Counts a render in live_try_ons for as long as it runs."""
+    global live_try_ons
+    with live_try_ons_lock:
+        live_try_ons += 1
     try:
-        image_gcs_uri = f"gs://{GCS_BUCKET_NAME}/{image_blob_name}"
-        video_filename = f"veo_{int(time.time())}.mp4"
-        output_video_gcs_uri = f"gs://{GCS_BUCKET_NAME}/veo/{video_filename}"
-        
-        video_url = generate_video_from_gcs(image_gcs_uri, output_video_gcs_uri)
+        yield
+    finally:
+        with live_try_ons_lock:
+            live_try_ons -= 1
+
+def render_try_on(person_image_path, clothing_image_paths, quality='full', cache_only=False, live=True):
+    """
+    Runs a virtual try-on at the given quality tier and queues the
+    resulting PNG for upload. Results are served from the try-on result
+    cache when the same inputs have been rendered before.
+
+    Returns a tuple of the normalized person image URI that was used, the
+    result's blob name and the result's content hash. With cache_only,
+    returns None instead of rendering on a cache miss. Renders count as
+    live traffic, which the warmer yields to, unless live is False.
+    """
+    # Inputs may still be sitting in the write-behind queue
+    for uri in [person_image_path] + clothing_image_paths:
+        blob_name = gcs.blob_name_from_uri(uri)
+        if blob_name and not gcs.wait_for_upload(blob_name):
+            raise UploadIncompleteError(f'Upload of {uri} did not complete')
+
+    # Always try on the normalized (oriented, downscaled) person photo;
+    # local files are uploaded to GCS as part of this
+    person_image_path = person_photo.prepare(person_image_path)
+    if not gcs.wait_for_upload(gcs.blob_name_from_uri(person_image_path)):
+        raise UploadIncompleteError('Upload of the normalized person photo did not complete')
+
+    lookup_started = time.monotonic()
+    key = vto_cache.cache_key(person_image_path, clothing_image_paths, quality)
+    cached = vto_cache.get(key)
+    if cached:
+        metrics.observe("vto.cache_hit", time.monotonic() - lookup_started)
+        return person_image_path, cached['blob_name'], cached['image_hash']
+    if cache_only:
+        return None
+
+    started = time.monotonic()
+    with counting_live_try_on() if live else contextlib.nullcontext():
+        generated_image = generate_virtual_try_on_image(person_image_path, clothing_image_paths, quality)
+    # Model time only, per tier: vto.preview_render_latency and vto.full_render_latency
+    metrics.observe(f"vto.{quality}_render_latency", time.monotonic() - started)
+
+    # Convert PIL image to bytes
+    img_byte_arr = io.BytesIO()
+    pil_image = generated_image._pil_image
+    with tracing.span("encode_png"):
+        pil_image.save(img_byte_arr, format='PNG')
+    img_byte_arr = img_byte_arr.getvalue()
+
+    # Queue the upload to GCS under the image's content hash;
+    # the staged copy is served until it lands
+    image_hash = gcs.content_hash(img_byte_arr)
+    blob_name = gcs.upload_content("vto", img_byte_arr, ".png", content_type='image/png')
+    vto_cache.put(key, blob_name, image_hash)
+    return person_image_path, blob_name, image_hash
+
+def warm_try_on(person_image_path, clothing_image_paths):
+    """Renders a full-quality try-on into the result cache for the warmer."""
+    if render_try_on(person_image_path, clothing_image_paths, cache_only=True):
+        return False
+    render_try_on(person_image_path, clothing_image_paths, live=False)
+    return True
+
+def featured_try_on_combinations():
+    """Every house model wearing each featured product, as the try-on page sends them."""
+    featured = load_catalog()[:3]
+    return [
+        (convert_to_gs_uri(model_url), [convert_to_gs_uri(product['image_urls']['large'])])
+        for model_url in HOUSE_MODEL_URLS
+        for product in featured
+    ]
+
+def live_try_ons_running():
+    return live_try_ons > 0
+
+def refine_try_on(generation_id, person_image_path, clothing_image_paths, started):
+    """Re-renders a preview try-on at full quality, then animates the result."""
+    try:
+        with deadlines.deadline(REFINE_BUDGET):
+            _, blob_name, image_hash = render_try_on(person_image_path, clothing_image_paths, 'full')
+        # Measured from the original request, so it includes the preview
+        metrics.observe("vto.time_to_final", time.monotonic() - started)
+        refine_status[generation_id] = {'status': 'done', 'image_url': gcs.media_url(blob_name), 'finished_at': time.time()}
+    except Exception as e:
+        print(f"Try-on refinement failed for {generation_id}: {e}")
+        refine_status[generation_id] = {'status': 'failed', 'image_url': None, 'finished_at': time.time()}
+        video_status[generation_id] = {'status': 'failed', 'url': None}
+        return
+
+    generate_and_store_video(generation_id, blob_name, image_hash)
+
+@app.route('/api/poll-refine/<generation_id>')
+def poll_refine(generation_id):
+    status = refine_status.get(generation_id, {'status': 'not_found', 'image_url': None})
+    if status['status'] == 'done':
+        # Swap the refined image into the session in place of the preview
+        session['vto_image_url'] = status['image_url']
+    return jsonify(status)
+
+@app.route('/api/metrics')
+def get_metrics():
+    """
+    Reports latency metrics. Try-on metrics are vto.preview_render_latency
+    and vto.full_render_latency (model renders), vto.cache_hit (results
+    served from the try-on cache) and vto.time_to_final (request start until
+    the full-quality image is ready, including any preview and refinement).
+    """
+    return jsonify(metrics.snapshot())
+
+@app.route('/api/vto-warmer')
+def vto_warmer_status():
+    return jsonify(vto_warmer.status())
+
+@app.route('/api/virtual-try-on/batch', methods=['POST'])
+@deadlines.budget(10)
+def virtual_try_on_batch_route():
+    """
+    Starts trying one outfit on many person images in parallel.
+
+    Takes apparel_gcs_uris and an optional person_image_gcs_uris list, which
+    defaults to the photos in profile_photos/, BATCH_TRY_ON_MAX_ITEMS at a
+    time. Pass the returned next_page_token as page_token to try the outfit
+    on the next page of photos. Returns a batch_id to poll with
+    /api/poll-batch/<batch_id>, which reports each item as it finishes.
+    """
+    data = request.get_json()
+    apparel_gcs_uris = data.get('apparel_gcs_uris')
+    person_image_gcs_uris = data.get('person_image_gcs_uris')
+    next_page_token = None
+
+    if not apparel_gcs_uris:
+        return jsonify({'error': 'apparel_gcs_uris is required'}), 400
+
+    if not person_image_gcs_uris:
+        blobs = gcs.get_bucket().list_blobs(
+            prefix="profile_photos/",
+            max_results=BATCH_TRY_ON_MAX_ITEMS,
+            page_token=data.get('page_token') or None,
+            timeout=deadlines.timeout(gcs.REQUEST_TIMEOUT),
+        )
+        person_image_gcs_uris = [gcs.gs_uri(blob.name) for blob in blobs if not blob.name.endswith('/')]
+        next_page_token = blobs.next_page_token
+
+    if len(person_image_gcs_uris) > BATCH_TRY_ON_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_TRY_ON_MAX_ITEMS} person images per batch'}), 400
+
+    clothing_image_paths = [convert_to_gs_uri(uri) for uri in apparel_gcs_uris]
+    person_image_paths = [convert_to_gs_uri(uri) for uri in person_image_gcs_uris]
+    batch_id = uuid.uuid4().hex
+    evict_finished(batch_status)
+    batch_status[batch_id] = {
+        'status': 'processing',
+        'items': [{'person_image': uri, 'status': 'processing', 'image_url': None, 'error': None} for uri in person_image_gcs_uris],
+    }
+
+    batch_thread = threading.Thread(target=tracing.propagate(run_try_on_batch), args=(batch_id, person_image_paths, clothing_image_paths))
+    batch_thread.start()
+
+    return jsonify({'batch_id': batch_id, 'items': batch_status[batch_id]['items'], 'next_page_token': next_page_token})
+
+def run_try_on_batch(batch_id, person_image_paths, clothing_image_paths):
+    items = batch_status[batch_id]['items']
+
+    def run_item(item, person_image_path):
+        try:
+            # Each item gets the same budget as a single try-on
+            with deadlines.deadline(BATCH_TRY_ON_ITEM_BUDGET):
+                _, blob_name, _ = render_try_on(person_image_path, clothing_image_paths)
+            item['image_url'] = gcs.media_url(blob_name)
+            item['status'] = 'done'
+        except Exception as e:
+            # Failed items are reported but do not stop the rest of the batch
+            print(f"Batch try-on failed for {item['person_image']}: {e}")
+            item['error'] = str(e)
+            item['status'] = 'failed'
+
+    with tracing.span("virtual_try_on.batch", items=len(items)):
+        list(batch_executor.map(tracing.propagate(run_item), items, person_image_paths))
+    batch_status[batch_id]['finished_at'] = time.time()
+    batch_status[batch_id]['status'] = 'done'
+
+@app.route('/api/poll-batch/<batch_id>')
+def poll_batch(batch_id):
+    status = batch_status.get(batch_id, {'status': 'not_found', 'items': []})
+    return jsonify(status)
+
+def generate_and_store_video(generation_id, image_blob_name, image_hash):
+    try:
+        # Veo reads the image from GCS, so wait for the queued upload to land
+        if not gcs.wait_for_upload(image_blob_name):
+            raise Exception(f"Upload of {image_blob_name} did not complete")
+
+        # Reuses an existing or in-flight video for the same image bytes
+        video_url = generate_video_for_image(gcs.gs_uri(image_blob_name), image_hash)
         video_status[generation_id] = {'status': 'done', 'url': video_url}
     except Exception as e:
         print(f"Video generation failed for {generation_id}: {e}")
         video_status[generation_id] = {'status': 'failed', 'url': None}
 
+@app.route('/media/<path:blob_name>')
+def media(blob_name):
+    """Serves a staged upload locally, or redirects to GCS once it has landed."""
+    try:
+        path = gcs.staged_path(blob_name)
+    except ValueError:
+        abort(404)
+    if path:
+        return send_file(os.path.abspath(path))
+    return redirect(gcs.public_url(blob_name))
+
+@app.route('/debug/traces')
+def debug_traces():
+    """Renders recent request traces as waterfalls; admin only, like /admin/*."""
+    require_admin()
+    try:
+        limit = int(request.args.get('limit', 20))
+    except (TypeError, ValueError):
+        limit = 20
+    return render_template('traces.html', traces=tracing.recent_traces(limit))
+
+def require_admin():
+    """Admin endpoints accept a profile token signed for the path "/admin"."""
+    if not profiling.is_authorized('/admin', profile_token()):
+        abort(403)
+
+@app.route('/admin/profile')
+def admin_sample_profile():
+    """Samples every worker thread for ?seconds=N and returns collapsed stacks."""
+    require_admin()
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except (TypeError, ValueError):
+        seconds = 10
+    try:
+        collapsed = profiling.sample_stacks(seconds)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return collapsed, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+@app.route('/admin/profiles')
+def admin_list_profiles():
+    require_admin()
+    return jsonify({'profiles': profiling.list_profiles()})
+
+@app.route('/admin/profiles/<filename>')
+def admin_get_profile(filename):
+    require_admin()
+    path = profiling.profile_path(filename)
+    if not path:
+        abort(404)
+    return send_file(path, as_attachment=True)
+
 @app.route('/api/poll-video/<path:generation_id>')
 def poll_video(generation_id):
     status = video_status.get(generation_id, {'status': 'not_found'})
@@ -346,6 +845,7 @@ def add_to_virtual_try_on():
     return redirect(url_for('virtual'))
 
 @app.route('/virtual')
+@deadlines.budget(5)
 def virtual():
     images = session.get('product_images', [])
     vto_image_url = session.get('vto_image_url')
@@ -353,14 +853,13 @@ def virtual():
     vto_clothing_images = session.get('vto_clothing_images')
     vto_video_url = session.get('vto_video_url')
 
-    # Get uploaded models from GCS
-    storage_client = storage.Client()
-    bucket_name = GCS_BUCKET_NAME
-    if bucket_name.startswith("gs://"):
-        bucket_name = bucket_name[5:]
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix="profile_photos/")
-    uploaded_models = [blob.public_url for blob in blobs]
+    # Get uploaded models from GCS; render without them if GCS is slow
+    try:
+        blobs = gcs.get_bucket().list_blobs(prefix="profile_photos/", timeout=deadlines.timeout(gcs.REQUEST_TIMEOUT))
+        uploaded_models = [blob.public_url for blob in blobs]
+    except Exception as e:
+        print(f"Could not list uploaded models: {e}")
+        uploaded_models = []
 
 
     # Check if the selected images have changed
@@ -373,14 +872,14 @@ def virtual():
 
     current_clothing_gs_uris = [convert_to_gs_uri(uri) for uri in current_clothing_images]
     if vto_image_url and vto_clothing_images and set(vto_clothing_images) == set(current_clothing_gs_uris):
-        return render_template('virtual.html', images=images, vto_image_url=vto_image_url, vto_video_url=vto_video_url, uploaded_models=uploaded_models)
+        return render_template('virtual.html', images=images, vto_image_url=vto_image_url, vto_video_url=vto_video_url, house_models=HOUSE_MODEL_URLS, uploaded_models=uploaded_models)
     else:
         # Clear the old VTO image if the items have changed
         session.pop('vto_image_url', None)
         session.pop('vto_video_url', None)
         session.pop('vto_person_image', None)
         session.pop('vto_clothing_images', None)
-        return render_template('virtual.html', images=images, uploaded_models=uploaded_models)
+        return render_template('virtual.html', images=images, house_models=HOUSE_MODEL_URLS, uploaded_models=uploaded_models)
 
 @app.route('/remove_from_virtual_try_on')
 def remove_from_virtual_try_on():
@@ -418,8 +917,7 @@ def add_to_cart():
     product_images = session.get('product_images', [])
     cart = session.get('cart', [])
     
-    with open('products.json') as f:
-        all_products = json.load(f)
+    all_products = load_catalog()
 
     for item in product_images:
         # Avoid adding duplicates
@@ -457,6 +955,7 @@ def remove_from_cart():
 
 
 @app.route('/api/upload', methods=['POST'])
+@deadlines.budget(30)
 def upload_file():
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
@@ -464,19 +963,46 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     if file:
-        filename = secure_filename(file.filename)
-        
-        # Upload to GCS
-        storage_client = storage.Client()
-        bucket_name = GCS_BUCKET_NAME
-        if bucket_name.startswith("gs://"):
-            bucket_name = bucket_name[5:]
-        bucket = storage_client.bucket(bucket_name)
-        
-        # Add a timestamp to the filename to avoid overwriting files
-        blob = bucket.blob(f"profile_photos/{int(time.time())}_{filename}")
-        
-        blob.upload_from_file(file, content_type=file.content_type)
-
-        return jsonify({'gcs_uri': f'gs://{bucket.name}/{blob.name}'})
-
+        # Orient, strip and downscale the photo once, then name the blob by the
+        # normalized bytes so the same photo is stored once; try-on waits for
+        # the queued upload before reading the photo
+        try:
+            blob_name = person_photo.store_upload(file.stream)
+        except person_photo.InvalidImageError as e:
+            return jsonify({'error': f'Unsupported or corrupt image: {e}'}), 400
+
+        return jsonify({'gcs_uri': gcs.gs_uri(blob_name)})
+
+# Keep featured products x house models rendered in the try-on result cache
+vto_warmer.start(warm_try_on, featured_try_on_combinations, live_try_ons_running)
+
+def warm_clients():
+    retail.get_search_client()
+    retail.get_product_client()
+    gcs.get_bucket()
+    gemini.get_client()
+
+def warm_templates():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def warm_get(path, **query_string):
+    """Requests a page through the full app so its caches and connections are primed."""
+    response = app.test_client().get(path, query_string=query_string)
+    if response.status_code >= 400:
+        raise Exception(f"{path} returned {response.status_code}")
+
+def warm_featured_products():
+    warm_get('/')
+    warm_get('/products')
+    for featured in load_catalog()[:3]:
+        warm_get(f"/product/{featured['id']}")
+
+# Readiness waits for these; /readyz reports each step's outcome
+warmup.start([
+    ('clients', warm_clients),
+    ('catalog', load_catalog),
+    ('templates', warm_templates),
+    ('default_search', lambda: warm_get('/api/products', q=DEFAULT_SEARCH_QUERY, page_size=DEFAULT_SEARCH_PAGE_SIZE)),
+    ('featured_products', warm_featured_products),
+])
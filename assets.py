@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import json
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = "static"
+# Fingerprinted copies and their compressed variants are written here
+BUILD_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST_PATH = os.path.join(BUILD_DIR, "manifest.json")
+# Only these directories are fingerprinted; uploads and generated images are not
+ASSET_DIRS = ("css", "js", "images")
+# Images are already compressed, so only text assets get .gz and .br variants
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".svg", ".json", ".txt")
+# Fingerprinted names change with their content, so browsers may keep them forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Preferred first: brotli is smaller, gzip is understood everywhere
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# logical name (e.g. "js/search.js") -> fingerprinted name (e.g. "js/search.3f2a9c1b04d7.js")
+_manifest = {}
+
+
+def build() -> dict:
+    """
+    Fingerprints every asset under ASSET_DIRS into BUILD_DIR, alongside
+    gzip and (if the brotli package is installed) brotli variants.
+
+    Unchanged assets are not rewritten, so this is cheap to run at every
+    startup. Writes and returns the manifest of logical to fingerprinted
+    names.
+    """
+    manifest = {}
+    for directory in ASSET_DIRS:
+        source_dir = os.path.join(STATIC_DIR, directory)
+        if not os.path.isdir(source_dir):
+            continue
+        for filename in sorted(os.listdir(source_dir)):
+            source = os.path.join(source_dir, filename)
+            if not os.path.isfile(source):
+                continue
+            with open(source, 'rb') as f:
+                data = f.read()
+            stem, extension = os.path.splitext(filename)
+            fingerprint = hashlib.sha256(data).hexdigest()[:12]
+            name = f"{directory}/{stem}.{fingerprint}{extension}"
+            _write_variants(name, data, extension)
+            manifest[f"{directory}/{filename}"] = name
+
+    _write_atomic(MANIFEST_PATH, json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    _manifest.clear()
+    _manifest.update(manifest)
+    return manifest
+
+
+def fingerprinted(filename: str):
+    """Returns the fingerprinted name of an asset, or None if it was not built."""
+    return _manifest.get(filename)
+
+
+def resolve(filename: str, accept_encoding: str):
+    """
+    Picks the file to serve for a fingerprinted asset name.
+
+    Args:
+        filename: A fingerprinted name, as returned by fingerprinted().
+        accept_encoding: The request's Accept-Encoding header value.
+
+    Returns:
+        A tuple of (path, content encoding or None), or None if the name is
+        not a built asset.
+    """
+    if filename not in _manifest.values():
+        return None
+    path = os.path.join(BUILD_DIR, filename)
+    accepted = _accepted_encodings(accept_encoding)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.exists(path + suffix):
+            return path + suffix, encoding
+    return path, None
+
+
+def _accepted_encodings(accept_encoding):
+    """Returns the encodings an Accept-Encoding header allows, skipping any with q=0."""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        encoding, *params = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if encoding and quality > 0:
+            accepted.add(encoding.lower())
+    return accepted
+
+
+def _write_variants(name, data, extension):
+    path = os.path.join(BUILD_DIR, name)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    if extension not in COMPRESSIBLE_EXTENSIONS:
+        return
+    if not os.path.exists(path + ".gz"):
+        # mtime=0 keeps the output byte-identical across builds
+        _write_atomic(path + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None and not os.path.exists(path + ".br"):
+        _write_atomic(path + ".br", brotli.compress(data, quality=11))
+
+
+def _write_atomic(path, data):
+    # Several workers may build at once; readers only ever see complete files
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    for logical, name in sorted(build().items()):
+        print(f"{logical} -> {name}")
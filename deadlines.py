@@ -0,0 +1,93 @@
+import contextlib
+import contextvars
+import functools
+import os
+import time
+from google.genai.types import HttpOptions
+
+# Absolute time.monotonic() deadline for the current request, if any
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the current request has used up its time budget."""
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """Runs the enclosed block under a time budget of `seconds`."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def budget(seconds: float):
+    """
+    Decorates a route so everything it calls shares a time budget.
+
+    The budget can be overridden with a DEADLINE_<ENDPOINT> environment
+    variable, e.g. DEADLINE_GET_PRODUCTS=3.
+    """
+    def decorator(fn):
+        limit = float(os.environ.get(f"DEADLINE_{fn.__name__.upper()}", seconds))
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with deadline(limit):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def remaining():
+    """Returns the seconds left in the current budget, or None without one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def timeout(default: float = None):
+    """
+    Returns the timeout to pass to an external call.
+
+    This is the time left in the current budget, capped at `default`. Outside
+    a budgeted request it is just `default`.
+
+    Raises:
+        DeadlineExceeded: If the budget has already run out.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return left if default is None else min(left, default)
+
+
+def timeout_ms(default: float = None):
+    """Same as timeout(), in whole milliseconds as the genai HttpOptions expect."""
+    seconds = timeout(default)
+    return None if seconds is None else max(1, int(seconds * 1000))
+
+
+def http_options(default: float = None):
+    """Returns genai HttpOptions carrying the current timeout, or None."""
+    ms = timeout_ms(default)
+    return None if ms is None else HttpOptions(timeout=ms)
+
+
+def propagate(fn):
+    """
+    Wraps fn so it runs with the caller's deadline (and other context
+    variables) when submitted to a thread pool or background thread.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # Each call gets its own copy so pool threads can run it concurrently
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
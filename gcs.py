@@ -0,0 +1,434 @@
+import functools
+import hashlib
+import mimetypes
+import os
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
+
+import deadlines
+import tracing
+
+# Uploaded bytes are staged here until GCS confirms the write
+STAGING_DIR = os.environ.get("GCS_STAGING_DIR", "static/uploads/staging")
+# Maximum number of uploads waiting for a worker before callers upload inline
+UPLOAD_QUEUE_SIZE = int(os.environ.get("GCS_UPLOAD_QUEUE_SIZE", 64))
+UPLOAD_WORKERS = int(os.environ.get("GCS_UPLOAD_WORKERS", 2))
+UPLOAD_MAX_ATTEMPTS = int(os.environ.get("GCS_UPLOAD_MAX_ATTEMPTS", 5))
+RETRY_INITIAL_DELAY = float(os.environ.get("GCS_RETRY_INITIAL_DELAY", 0.5))
+RETRY_MAX_DELAY = float(os.environ.get("GCS_RETRY_MAX_DELAY", 30))
+# Seconds between sweeps that re-queue failed uploads whose staged copy is still here
+RETRY_SWEEP_INTERVAL = float(os.environ.get("GCS_RETRY_SWEEP_INTERVAL", 60))
+# Files at least this large use resumable uploads in chunks of this size
+CHUNK_SIZE = int(os.environ.get("GCS_CHUNK_SIZE", 8 * 1024 * 1024))
+# Files at least this large are uploaded as parallel chunks
+PARALLEL_UPLOAD_THRESHOLD = int(os.environ.get("GCS_PARALLEL_UPLOAD_THRESHOLD", 64 * 1024 * 1024))
+PARALLEL_UPLOAD_WORKERS = int(os.environ.get("GCS_PARALLEL_UPLOAD_WORKERS", 8))
+# Longest a single GCS request may take; request deadlines cap this further
+REQUEST_TIMEOUT = float(os.environ.get("GCS_REQUEST_TIMEOUT", 60))
+UPLOAD_TIMEOUT = float(os.environ.get("GCS_UPLOAD_TIMEOUT", 300))
+
+# Staged files are served from this URL prefix while their upload is pending
+MEDIA_URL_PREFIX = "/media/"
+PUBLIC_URL_PREFIX = "https://storage.googleapis.com/"
+
+_client = None
+_client_lock = threading.Lock()
+
+_queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+_workers = []
+_workers_lock = threading.Lock()
+
+# blob name -> {'status': 'pending' | 'done' | 'failed', 'event': threading.Event,
+#               'callbacks': [fn, ...] run once the blob lands, 'content_type': str}
+# Entries are dropped once the upload lands; failed ones stay until a retry succeeds
+_uploads = {}
+_uploads_lock = threading.Lock()
+
+# Blob names known to exist in GCS, so repeat existence checks skip the round trip
+_known_blobs = set()
+
+
+def bucket_name() -> str:
+    """Returns the configured bucket name without any gs:// prefix."""
+    name = os.environ.get("GCS_BUCKET_NAME", "")
+    if name.startswith("gs://"):
+        name = name[5:]
+    return name.rstrip("/")
+
+
+def get_client() -> storage.Client:
+    """Returns the shared storage client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = storage.Client()
+    return _client
+
+
+def get_bucket() -> storage.Bucket:
+    return get_client().bucket(bucket_name())
+
+
+def gs_uri(blob_name: str) -> str:
+    return f"gs://{bucket_name()}/{blob_name}"
+
+
+def public_url(blob_name: str) -> str:
+    return f"{PUBLIC_URL_PREFIX}{bucket_name()}/{blob_name}"
+
+
+def media_url(blob_name: str) -> str:
+    return f"{MEDIA_URL_PREFIX}{blob_name}"
+
+
+def blob_name_from_uri(uri: str, host: str = None):
+    """
+    Returns the blob name for a gs://, public or media URL in our bucket.
+
+    Media URLs may be relative, or absolute on `host` (the app's own host);
+    browsers hand back the absolute form (e.g. ``http://host/media/...``)
+    when the URL is read from the page. /media/ paths on other hosts are
+    not ours.
+
+    Returns None if the URI does not point into the configured bucket.
+    """
+    parsed = urlparse(uri)
+    if uri.startswith("gs://"):
+        bucket, _, name = uri[5:].partition("/")
+    elif uri.startswith(PUBLIC_URL_PREFIX):
+        bucket, _, name = parsed.path.lstrip("/").partition("/")
+    elif parsed.path.startswith(MEDIA_URL_PREFIX) and (
+        (not parsed.scheme and not parsed.netloc)
+        or (parsed.scheme in ("http", "https") and host is not None and parsed.netloc == host)
+    ):
+        return parsed.path[len(MEDIA_URL_PREFIX):] or None
+    else:
+        return None
+    if bucket != bucket_name() or not name:
+        return None
+    return name
+
+
+def content_hash(data: bytes) -> str:
+    """Returns the hex digest used to name content-addressed blobs."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def inputs_hash(*parts) -> str:
+    """Returns a content-address for a generated asset from its request inputs."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def exists(blob_name: str) -> bool:
+    """Returns True if the blob is in GCS, staged locally or queued for upload."""
+    if blob_name in _known_blobs:
+        return True
+    with _uploads_lock:
+        entry = _uploads.get(blob_name)
+    if entry and entry['status'] != 'failed':
+        return True
+    return _exists_in_bucket(blob_name)
+
+
+def staged_path(blob_name: str):
+    """Returns the local staged copy of a blob, or None if there isn't one."""
+    path = _staging_path(blob_name)
+    return path if os.path.isfile(path) else None
+
+
+def upload_status(blob_name: str):
+    """Returns 'pending', 'done' or 'failed', or None for unknown blobs."""
+    with _uploads_lock:
+        entry = _uploads.get(blob_name)
+        if entry:
+            return entry['status']
+    return 'done' if blob_name in _known_blobs else None
+
+
+def on_uploaded(blob_name: str, callback):
+    """
+    Calls callback() once a queued upload has landed in GCS.
+
+    The callback runs on the upload worker, or right away if the blob is
+    already in GCS or was never queued by this process. It survives failed
+    attempts and runs when a later retry succeeds.
+    """
+    with _uploads_lock:
+        entry = _uploads.get(blob_name)
+        if entry is not None and blob_name not in _known_blobs:
+            entry['callbacks'].append(callback)
+            return
+    callback()
+
+
+def wait_for_upload(blob_name: str, timeout: float = None) -> bool:
+    """
+    Blocks until a queued upload finishes.
+
+    Returns True if the blob is in GCS (or was never queued by this process),
+    False if the upload failed or did not finish within the timeout. The
+    timeout is capped by the current request's deadline.
+    """
+    timeout = deadlines.timeout(timeout)
+    with _uploads_lock:
+        entry = _uploads.get(blob_name)
+    if entry is None:
+        return True
+    with tracing.span("gcs.wait_for_upload", blob=blob_name):
+        if not entry['event'].wait(timeout):
+            return False
+    return entry['status'] == 'done'
+
+
+def upload_bytes(blob_name: str, data: bytes, content_type: str = None) -> str:
+    """
+    Stages bytes locally and queues them for upload to GCS.
+
+    Never calls GCS on the caller's thread: the upload worker skips blobs
+    that are already in the bucket. Bytes already uploaded or queued by
+    this process are not queued again.
+
+    Returns the gs:// URI the blob will have once uploaded.
+    """
+    if not _register(blob_name):
+        return gs_uri(blob_name)
+    path = _staging_path(blob_name)
+    try:
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        _finish(blob_name, 'failed')
+        raise
+    _enqueue(blob_name, path, content_type)
+    return gs_uri(blob_name)
+
+
+def upload_content(prefix: str, data: bytes, extension: str, content_type: str = None) -> str:
+    """
+    Queues bytes for upload under a name derived from their content hash.
+
+    Bytes that are already in the bucket are not uploaded again.
+
+    Returns the blob name, e.g. ``vto/<sha256>.png``.
+    """
+    blob_name = f"{prefix}/{content_hash(data)}{extension}"
+    upload_bytes(blob_name, data, content_type)
+    return blob_name
+
+
+def resume_pending():
+    """
+    Re-queues staged files that are not uploading: those left behind by a
+    previous process, and uploads that gave up after UPLOAD_MAX_ATTEMPTS.
+    Runs at startup and then every RETRY_SWEEP_INTERVAL seconds, so
+    'failed' is never final while the staged copy exists.
+    """
+    if not os.path.isdir(STAGING_DIR):
+        return
+    for root, _, files in os.walk(STAGING_DIR):
+        for filename in files:
+            if filename.endswith(".tmp"):
+                continue
+            path = os.path.join(root, filename)
+            blob_name = os.path.relpath(path, STAGING_DIR).replace(os.sep, "/")
+            with _uploads_lock:
+                entry = _uploads.get(blob_name)
+                content_type = entry.get('content_type') if entry else None
+            if not _register(blob_name):
+                continue
+            print(f"Resuming pending upload of {blob_name}")
+            _enqueue(blob_name, path, content_type)
+
+
+def _staging_path(blob_name: str) -> str:
+    path = os.path.normpath(os.path.join(STAGING_DIR, blob_name))
+    if not path.startswith(os.path.normpath(STAGING_DIR) + os.sep):
+        raise ValueError(f"Invalid blob name: {blob_name}")
+    return path
+
+
+def _tmp_path(path: str) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f"{path}.{threading.get_ident()}.tmp"
+
+
+def _guess_type(blob_name: str):
+    return mimetypes.guess_type(blob_name)[0] or "application/octet-stream"
+
+
+def _exists_in_bucket(blob_name):
+    with tracing.span("gcs.exists", blob=blob_name):
+        found = get_bucket().blob(blob_name).exists(timeout=deadlines.timeout(REQUEST_TIMEOUT))
+    if found:
+        _known_blobs.add(blob_name)
+    return found
+
+
+def _register(blob_name):
+    """Marks a blob as pending; returns False if it is already uploaded or queued."""
+    with _uploads_lock:
+        if blob_name in _known_blobs:
+            return False
+        entry = _uploads.get(blob_name)
+        if entry and entry['status'] == 'pending':
+            return False
+        # Callbacks waiting on a failed attempt carry over to the retry
+        callbacks = entry['callbacks'] if entry else []
+        _uploads[blob_name] = {'status': 'pending', 'event': threading.Event(), 'callbacks': callbacks}
+        return True
+
+
+def _finish(blob_name, status):
+    callbacks = []
+    with _uploads_lock:
+        entry = _uploads.get(blob_name)
+        if entry:
+            entry['status'] = status
+            entry['event'].set()
+            # Waiters keep their own reference; _known_blobs answers later lookups
+            if status == 'done':
+                del _uploads[blob_name]
+                callbacks = entry['callbacks']
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Upload callback for {blob_name} failed: {e}")
+
+
+def _enqueue(blob_name, path, content_type):
+    content_type = content_type or _guess_type(blob_name)
+    with _uploads_lock:
+        entry = _uploads.get(blob_name)
+        if entry:
+            entry['content_type'] = content_type
+    _ensure_workers()
+    # Upload spans are recorded under the span that queued them
+    task = tracing.propagate(functools.partial(_process, blob_name, path, content_type))
+    try:
+        _queue.put_nowait(task)
+    except queue.Full:
+        # Apply backpressure by uploading on the caller's thread
+        print(f"Upload queue full, uploading {blob_name} inline")
+        task()
+
+
+def _ensure_workers():
+    if _workers:
+        return
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(UPLOAD_WORKERS):
+            worker = threading.Thread(target=_worker, name=f"gcs-upload-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+        sweeper = threading.Thread(target=_retry_sweeper, name="gcs-upload-retry", daemon=True)
+        sweeper.start()
+        _workers.append(sweeper)
+
+
+def _retry_sweeper():
+    while True:
+        time.sleep(RETRY_SWEEP_INTERVAL)
+        try:
+            resume_pending()
+        except Exception as e:
+            print(f"Upload retry sweep failed: {e}")
+
+
+def _worker():
+    while True:
+        task = _queue.get()
+        try:
+            task()
+        finally:
+            _queue.task_done()
+
+
+def _process(blob_name, path, content_type):
+    status = 'failed'
+    try:
+        # Content-addressed blobs are often already in the bucket
+        if not _already_uploaded(blob_name):
+            _upload_with_retry(blob_name, path, content_type)
+            _known_blobs.add(blob_name)
+        status = 'done'
+        os.remove(path)
+    except FileNotFoundError:
+        # Another task already uploaded the blob and removed the staged copy
+        if blob_name in _known_blobs:
+            status = 'done'
+    except Exception as e:
+        # Keep the staged file so the bytes are not lost; resume_pending() retries it
+        print(f"Giving up on upload of {blob_name}, staged copy kept at {path}: {e}")
+    finally:
+        _finish(blob_name, status)
+
+
+def _already_uploaded(blob_name):
+    if blob_name in _known_blobs:
+        return True
+    try:
+        return _exists_in_bucket(blob_name)
+    except deadlines.DeadlineExceeded:
+        raise
+    except Exception as e:
+        # Uploading again is harmless; it only rewrites the same blob
+        print(f"Could not check whether {blob_name} exists, uploading it: {e}")
+        return False
+
+
+def _upload_with_retry(blob_name, path, content_type):
+    delay = RETRY_INITIAL_DELAY
+    for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+        try:
+            _upload(blob_name, path, content_type)
+            return
+        except deadlines.DeadlineExceeded:
+            raise
+        except Exception as e:
+            if attempt == UPLOAD_MAX_ATTEMPTS:
+                raise
+            print(f"Upload of {blob_name} failed (attempt {attempt}/{UPLOAD_MAX_ATTEMPTS}): {e}")
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+
+def _upload(blob_name, path, content_type):
+    size = os.path.getsize(path)
+    with tracing.span("gcs.upload", blob=blob_name, bytes=size):
+        _upload_file(blob_name, path, content_type, size)
+
+
+def _upload_file(blob_name, path, content_type, size):
+    # Background workers have no request deadline; inline uploads do
+    timeout = deadlines.timeout(UPLOAD_TIMEOUT)
+    blob = get_bucket().blob(blob_name)
+    if size >= PARALLEL_UPLOAD_THRESHOLD:
+        transfer_manager.upload_chunks_concurrently(
+            path,
+            blob,
+            content_type=content_type,
+            chunk_size=CHUNK_SIZE,
+            worker_type=transfer_manager.THREAD,
+            max_workers=PARALLEL_UPLOAD_WORKERS,
+            deadline=timeout,
+        )
+        return
+    if size >= CHUNK_SIZE:
+        blob.chunk_size = CHUNK_SIZE
+    blob.upload_from_filename(path, content_type=content_type, timeout=timeout)
@@ -1,5 +1,11 @@
+import hashlib
 import logging
 import os
+import random
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 
@@ -7,21 +13,188 @@ from google import genai
 from google.genai import types
 from google.genai.types import HttpOptions
 
-def generate_response(prompt, thinking_budget=0):
+import deadlines
+import imagen
+import tracing
+
+# Bounded LRU cache of responses keyed by (model, prompt, thinking_budget)
+RESPONSE_CACHE_SIZE = int(os.environ.get("GEMINI_RESPONSE_CACHE_SIZE", 256))
+# Maximum number of prompts in flight at once for generate_responses()
+BATCH_MAX_WORKERS = int(os.environ.get("GEMINI_BATCH_MAX_WORKERS", 8))
+# Prompts and responses are truncated to this many characters in the logs
+LOG_MAX_CHARS = int(os.environ.get("GEMINI_LOG_MAX_CHARS", 200))
+# Fraction of calls whose full response object is logged at DEBUG
+LOG_SAMPLE_RATE = float(os.environ.get("GEMINI_LOG_SAMPLE_RATE", 0.01))
+# Generated images are kept here, named by a hash of the prompt
+IMAGE_CACHE_DIR = os.environ.get("GEMINI_IMAGE_CACHE_DIR", "static/images/generated")
+
+_client = None
+_client_lock = threading.Lock()
+
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+# Striped by cache key so concurrent identical prompts generate once, with a
+# fixed number of locks however many prompts are seen
+IMAGE_LOCK_STRIPES = 64
+_image_locks = [threading.Lock() for _ in range(IMAGE_LOCK_STRIPES)]
+
+
+def get_client():
+    """Returns the shared genai client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = genai.Client(http_options=HttpOptions(api_version="v1"))
+    return _client
+
+
+def _truncate(text, limit=LOG_MAX_CHARS):
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... ({len(text)} chars)"
+
+
+def _cache_get(key):
+    with _response_cache_lock:
+        if key not in _response_cache:
+            return None
+        _response_cache.move_to_end(key)
+        return _response_cache[key]
+
+
+def _cache_put(key, response):
+    if RESPONSE_CACHE_SIZE <= 0:
+        return
+    with _response_cache_lock:
+        _response_cache[key] = response
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+def clear_cache():
+    """Drops every cached response."""
+    with _response_cache_lock:
+        _response_cache.clear()
+
+
+def generate_response(prompt, thinking_budget=None, use_cache=True):
+    """
+    Generates a response from Gemini for the given prompt.
+
+    Args:
+        prompt: The prompt to send to the model.
+        thinking_budget: The thinking budget to use. The default (None)
+            leaves it unset so the model uses its own default; pass 0 to
+            turn thinking off.
+        use_cache: Whether to serve and store the response in the cache.
+
+    Returns:
+        The GenerateContentResponse from the model.
+    """
     model = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
-    client = genai.Client(http_options=HttpOptions(api_version="v1"))
-
-    logging.info(f"Generating response for prompt: {prompt}")
-    response = client.models.generate_content(
-        model=model,
-        config=types.GenerateContentConfig(
-            thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget)
-        ),
-        contents=prompt
-    )
-    logging.info(f"Generated response: {response}")
+    key = (model, prompt, thinking_budget)
+
+    if use_cache:
+        cached = _cache_get(key)
+        if cached is not None:
+            logging.debug(f"Gemini cache hit for prompt: {_truncate(prompt)}")
+            return cached
+
+    config_kwargs = {}
+    if thinking_budget is not None:
+        config_kwargs['thinking_config'] = types.ThinkingConfig(thinking_budget=thinking_budget)
+    http_options = deadlines.http_options()
+    if http_options is not None:
+        config_kwargs['http_options'] = http_options
+    config = types.GenerateContentConfig(**config_kwargs) if config_kwargs else None
+
+    logging.info(f"Generating response for prompt: {_truncate(prompt)}")
+    with tracing.span("gemini.generate_content", model=model):
+        response = get_client().models.generate_content(
+            model=model,
+            config=config,
+            contents=prompt
+        )
+    logging.info(f"Generated response: {_truncate(response.text)}")
+    if random.random() < LOG_SAMPLE_RATE:
+        logging.debug(f"Sampled full response: {response}")
+
+    if use_cache:
+        _cache_put(key, response)
     return response
 
-def generate_image(prompt, path):
-    #todo - use imagen to generate image and save it into a GCS bucket
-    return False
+
+def generate_responses(prompts, thinking_budget=None, max_workers=BATCH_MAX_WORKERS):
+    """
+    Generates responses for many prompts concurrently.
+
+    Args:
+        prompts: A list of prompts.
+        thinking_budget: The thinking budget applied to every prompt; None
+            leaves it unset, as in generate_response().
+        max_workers: The maximum number of requests in flight at once.
+
+    Returns:
+        A list with one entry per prompt, in the same order. Each entry is
+        either the response or the exception raised for that prompt.
+    """
+    def run(prompt):
+        try:
+            return generate_response(prompt, thinking_budget)
+        except Exception as e:
+            logging.error(f"Batch prompt failed: {_truncate(prompt)}: {e}")
+            return e
+
+    if not prompts:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prompts)))) as executor:
+        return list(executor.map(deadlines.propagate(run), prompts))
+
+
+def _image_lock(key):
+    return _image_locks[int(key[:8], 16) % IMAGE_LOCK_STRIPES]
+
+
+def generate_image(prompt, path=None, quality='full'):
+    """
+    Generates an image with Imagen and saves it to the given path.
+
+    Images are cached on disk by prompt, so repeating a prompt copies the
+    cached file instead of calling the model again.
+
+    Args:
+        prompt: The prompt to generate the image from.
+        path: The local path to write the PNG image to. If omitted, the
+            cached file's path is returned without making a copy.
+        quality: An imagen.QUALITY_TIERS key. Each tier is cached separately.
+
+    Returns:
+        The path the image was written to.
+    """
+    key = hashlib.sha256(f"{quality}\0{prompt}".encode("utf-8")).hexdigest()
+    cached_path = os.path.join(IMAGE_CACHE_DIR, f"{key}.png")
+
+    with _image_lock(key):
+        if not os.path.exists(cached_path):
+            logging.info(f"Generating image for prompt: {_truncate(prompt)}")
+            generated_image = imagen.generate_image(prompt, quality)
+            pil_image = generated_image._pil_image if hasattr(generated_image, '_pil_image') else generated_image
+
+            os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cached_path}.{threading.get_ident()}.tmp"
+            with tracing.span("encode_png"):
+                pil_image.save(tmp_path, format='PNG')
+            os.replace(tmp_path, cached_path)
+        else:
+            logging.info(f"Image cache hit for prompt: {_truncate(prompt)}")
+
+    if path is None:
+        return cached_path
+    if os.path.abspath(path) != os.path.abspath(cached_path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        shutil.copyfile(cached_path, path)
+    return path
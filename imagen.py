@@ -4,11 +4,28 @@ from PIL import Image as PIL_Image
 from google import genai
 from google.genai import types
 
+import deadlines
+import tracing
+
 # Configure the Gemini client
 PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
 LOCATION = os.environ.get("GOOGLE_CLOUD_REGION", "us-central1")
 client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
 
+# Model and output size for each quality tier: the fast model for previews,
+# the standard model for full quality
+QUALITY_TIERS = {
+    'preview': {
+        'model': os.environ.get("IMAGEN_PREVIEW_MODEL", "imagen-4.0-fast-generate-001"),
+        'image_size': os.environ.get("IMAGEN_PREVIEW_SIZE", "1K"),
+    },
+    'full': {
+        'model': os.environ.get("IMAGEN_FULL_MODEL", "imagen-4.0-generate-001"),
+        'image_size': os.environ.get("IMAGEN_FULL_SIZE", "2K"),
+    },
+}
+
+@tracing.traced("imagen.rewrite_prompt")
 def rewrite_prompt(prompt: str) -> tuple[str, str]:
     """
     Rewrites a given prompt using the Gemini API for better image generation.
@@ -31,7 +48,8 @@ def rewrite_prompt(prompt: str) -> tuple[str, str]:
                   f"The image must not include a model, just the **single** piece of clothing. "
                   f"If no gender is specified, default to a gender neutral style. "
                   f"Output the title and the rewritten prompt on separate lines, with the title first. "
-                  f"Original prompt: '{prompt}'"]
+                  f"Original prompt: '{prompt}'"],
+        config=types.GenerateContentConfig(http_options=deadlines.http_options()),
     )
     # The model sometimes still returns the prompt in quotes, so we remove them.
     parts = response.text.strip().split('\n')
@@ -41,27 +59,30 @@ def rewrite_prompt(prompt: str) -> tuple[str, str]:
         rewritten = rewritten[1:-1]
     return rewritten, title
 
-def generate_image(prompt: str) -> PIL_Image.Image:
+@tracing.traced("imagen.generate_images")
+def generate_image(prompt: str, quality: str = 'full') -> PIL_Image.Image:
     """
     Generates an image using the Imagen API from a given prompt.
 
     Args:
         prompt: The prompt to generate the image from.
+        quality: A key of QUALITY_TIERS, selecting the model and image size.
 
     Returns:
         The generated image as a PIL Image object.
     """
-    generation_model = "imagen-4.0-fast-generate-001"
+    tier = QUALITY_TIERS[quality]
     
     response = client.models.generate_images(
-        model=generation_model,
+        model=tier['model'],
         prompt=prompt,
         config=types.GenerateImagesConfig(
             number_of_images=1,
             aspect_ratio="1:1",
-            image_size="2K",
+            image_size=tier['image_size'],
             safety_filter_level="BLOCK_MEDIUM_AND_ABOVE",
             person_generation="ALLOW_ADULT",
+            http_options=deadlines.http_options(),
         ),
     )
     
@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import deque
+
+# Number of recent observations kept per metric for percentiles
+WINDOW = int(os.environ.get("METRICS_WINDOW", 1000))
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    """Counts observations and keeps a rolling window for percentiles."""
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.total = 0.0
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self._samples.append(value)
+
+    def samples(self) -> int:
+        """Returns the number of observations in the rolling window."""
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, pct: float):
+        """Returns the pct-th percentile of the rolling window, or None if it is empty."""
+        with self._lock:
+            samples = sorted(self._samples)
+        return _percentile(samples, pct)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total = self.count, self.total
+        return {
+            'count': count,
+            'mean': total / count if count else None,
+            'p50': _percentile(samples, 50),
+            'p95': _percentile(samples, 95),
+            'p99': _percentile(samples, 99),
+        }
+
+
+def _percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * pct / 100))]
+
+
+def observe(name: str, value: float):
+    """Records one observation, e.g. a latency in seconds."""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram(WINDOW)
+    histogram.observe(value)
+
+
+def snapshot() -> dict:
+    """Returns count, mean and percentiles for every metric."""
+    with _lock:
+        histograms = dict(_histograms)
+    return {name: histogram.snapshot() for name, histogram in sorted(histograms.items())}
@@ -0,0 +1,54 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# Number of rendered pages kept; each holds a plain and a gzipped body
+MAX_ENTRIES = int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", 512))
+
+_pages = OrderedDict()
+_lock = threading.Lock()
+
+
+class Page:
+    """A rendered page with its gzipped body and strong ETags for both."""
+
+    def __init__(self, body: str):
+        self.body = body.encode("utf-8")
+        # mtime=0 keeps the gzipped bytes, and so their ETag, stable
+        self.gzipped = gzip.compress(self.body, compresslevel=6, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        # Different bytes on the wire, so the gzipped body gets its own strong ETag
+        self.gzipped_etag = f"{self.etag}-gzip"
+
+
+def get_or_render(key: tuple, render) -> Page:
+    """
+    Returns the cached page for a key, rendering and caching it on a miss.
+
+    Args:
+        key: Identifies the page; include everything the HTML depends on,
+            such as the template, product ID and catalog version.
+        render: Called with no arguments on a miss; returns the HTML. It
+            must not depend on the session or anything else per-user.
+    """
+    with _lock:
+        if key in _pages:
+            _pages.move_to_end(key)
+            return _pages[key]
+
+    # Concurrent misses may both render; the result is identical either way
+    page = Page(render())
+    with _lock:
+        _pages[key] = page
+        _pages.move_to_end(key)
+        while len(_pages) > MAX_ENTRIES:
+            _pages.popitem(last=False)
+    return page
+
+
+def clear():
+    """Drops every cached page, e.g. after the catalog changes."""
+    with _lock:
+        _pages.clear()
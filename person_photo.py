@@ -0,0 +1,119 @@
+import io
+import os
+import re
+import threading
+from PIL import Image as PIL_Image, ImageOps
+
+import deadlines
+import gcs
+import tracing
+
+# Longest edge of the normalized photo; the try-on model gains nothing above this
+MAX_DIMENSION = int(os.environ.get("PERSON_PHOTO_MAX_DIMENSION", 1024))
+JPEG_QUALITY = int(os.environ.get("PERSON_PHOTO_JPEG_QUALITY", 90))
+
+# Uploads through /api/upload are normalized before they are stored here
+UPLOAD_PREFIX = "profile_photos"
+# Normalized copies of any other person image, keyed by a hash of its URI
+NORMALIZED_PREFIX = "person_photos"
+
+_NORMALIZED_BLOB = re.compile(rf"^({UPLOAD_PREFIX}|{NORMALIZED_PREFIX})/[0-9a-f]{{64}}\.jpg$")
+
+# source URI -> gs:// URI of its normalized copy
+_normalized = {}
+_normalized_lock = threading.Lock()
+
+
+class InvalidImageError(ValueError):
+    """Raised when a photo cannot be decoded: unknown format, truncated or too large."""
+
+
+@tracing.traced("person_photo.normalize")
+def normalize(fileobj) -> bytes:
+    """
+    Normalizes a person photo for virtual try-on.
+
+    Applies the EXIF orientation, drops all metadata, downscales so the
+    longest edge is at most MAX_DIMENSION and re-encodes as JPEG.
+
+    Args:
+        fileobj: A file-like object with the original image bytes.
+
+    Returns:
+        The normalized JPEG bytes.
+
+    Raises:
+        InvalidImageError: If the image cannot be decoded.
+    """
+    try:
+        image = PIL_Image.open(fileobj)
+        # Let the JPEG decoder skip detail we are about to throw away
+        image.draft('RGB', (MAX_DIMENSION * 2, MAX_DIMENSION * 2))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+        image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), PIL_Image.LANCZOS)
+    except (PIL_Image.DecompressionBombError, OSError) as e:
+        # OSError covers UnidentifiedImageError and truncated files
+        raise InvalidImageError(str(e)) from e
+
+    output = io.BytesIO()
+    # A fresh encode without exif= or icc_profile= carries no metadata
+    image.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def store_upload(fileobj) -> str:
+    """
+    Normalizes an uploaded person photo and queues it for upload.
+
+    Returns the blob name, named by the hash of the normalized bytes.
+    """
+    data = normalize(fileobj)
+    return gcs.upload_content(UPLOAD_PREFIX, data, ".jpg", content_type='image/jpeg')
+
+
+def prepare(person_image_path: str) -> str:
+    """
+    Returns the gs:// URI of the normalized variant of a person image.
+
+    Uploads through /api/upload and earlier results of prepare() are
+    already normalized and returned as-is.
+    Anything else (house models, older uploads, local files) is normalized
+    once and stored under NORMALIZED_PREFIX for every later try-on.
+
+    Args:
+        person_image_path: A gs:// URI or local path.
+    """
+    blob_name = gcs.blob_name_from_uri(person_image_path)
+    if blob_name and _NORMALIZED_BLOB.match(blob_name):
+        return person_image_path
+
+    with _normalized_lock:
+        normalized_uri = _normalized.get(person_image_path)
+        if normalized_uri is not None:
+            # A failed upload is normalized and queued again below
+            if gcs.upload_status(gcs.blob_name_from_uri(normalized_uri)) != 'failed':
+                return normalized_uri
+            del _normalized[person_image_path]
+
+    if person_image_path.startswith("gs://"):
+        target = f"{NORMALIZED_PREFIX}/{gcs.inputs_hash(person_image_path)}.jpg"
+        if not gcs.exists(target):
+            data = normalize(io.BytesIO(_download(person_image_path)))
+            gcs.upload_bytes(target, data, content_type='image/jpeg')
+    else:
+        with open(person_image_path, 'rb') as f:
+            data = normalize(f)
+        target = gcs.upload_content(NORMALIZED_PREFIX, data, ".jpg", content_type='image/jpeg')
+
+    normalized_uri = gcs.gs_uri(target)
+    with _normalized_lock:
+        _normalized[person_image_path] = normalized_uri
+    return normalized_uri
+
+
+def _download(gcs_uri: str) -> bytes:
+    bucket_name, _, name = gcs_uri[5:].partition("/")
+    with tracing.span("gcs.download", uri=gcs_uri):
+        blob = gcs.get_client().bucket(bucket_name).blob(name)
+        return blob.download_as_bytes(timeout=deadlines.timeout(gcs.REQUEST_TIMEOUT))
@@ -0,0 +1,134 @@
+import cProfile
+import hashlib
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+# Profiling is disabled unless this secret is set
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Number of stored profiles kept before the oldest are deleted
+PROFILE_RETENTION = int(os.environ.get("PROFILE_RETENTION", 50))
+SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.01))
+MAX_SAMPLE_SECONDS = float(os.environ.get("PROFILE_MAX_SAMPLE_SECONDS", 60))
+
+# Requests opt in with this header or query parameter carrying sign(path)
+PROFILE_HEADER = "X-Profile-Token"
+PROFILE_PARAM = "_profile"
+
+_sampling_lock = threading.Lock()
+
+
+def sign(path: str) -> str:
+    """Returns the token that authorizes profiling requests to `path`."""
+    return hmac.new(PROFILE_SECRET.encode("utf-8"), path.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def is_authorized(path: str, token: str) -> bool:
+    if not PROFILE_SECRET or not token:
+        return False
+    return hmac.compare_digest(sign(path), token)
+
+
+def start_request_profile() -> cProfile.Profile:
+    """Starts a cProfile session; it only covers the calling thread."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def finish_request_profile(profiler: cProfile.Profile, label: str) -> str:
+    """
+    Stops a request profile and stores it as .pstats plus a text summary.
+
+    Returns the stored profile's name.
+    """
+    profiler.disable()
+    name = _profile_name(label)
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}.pstats"))
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(40)
+    _write(f"{name}.txt", summary.getvalue())
+    _enforce_retention()
+    return name
+
+
+def sample_stacks(seconds: float) -> str:
+    """
+    Samples the stacks of every thread for `seconds` and returns them in
+    collapsed format ("thread;frame;frame count" per line), ready for
+    flamegraph.pl or speedscope. The result is also stored locally.
+
+    Raises:
+        RuntimeError: If another sampling run is already in progress.
+    """
+    seconds = max(0.0, min(seconds, MAX_SAMPLE_SECONDS))
+    if not _sampling_lock.acquire(blocking=False):
+        raise RuntimeError("A sampling profile is already running")
+    try:
+        own_thread = threading.get_ident()
+        counts = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(SAMPLE_INTERVAL)
+    finally:
+        _sampling_lock.release()
+
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+    _write(f"{_profile_name('sampled')}.collapsed", collapsed)
+    _enforce_retention()
+    return collapsed
+
+
+def list_profiles() -> list:
+    """Returns stored profile file names, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted(os.listdir(PROFILE_DIR), reverse=True)
+
+
+def profile_path(filename: str):
+    """Returns the path of a stored profile, or None if it does not exist."""
+    if filename not in list_profiles():
+        return None
+    return os.path.abspath(os.path.join(PROFILE_DIR, filename))
+
+
+def _profile_name(label: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe_label = "".join(c if c.isalnum() or c in "-_" else "_" for c in label)
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{safe_label}"
+
+
+def _write(filename: str, content: str):
+    with open(os.path.join(PROFILE_DIR, filename), 'w') as f:
+        f.write(content)
+
+
+def _enforce_retention():
+    # A request profile is two files (.pstats and .txt), so group by stem
+    stems = sorted({os.path.splitext(f)[0] for f in list_profiles()}, reverse=True)
+    for stem in stems[PROFILE_RETENTION:]:
+        for filename in list_profiles():
+            if os.path.splitext(filename)[0] == stem:
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, filename))
+                except OSError:
+                    pass
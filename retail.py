@@ -0,0 +1,286 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from google.api_core.exceptions import ClientError
+from google.cloud import retail_v2
+
+import deadlines
+import metrics
+import tracing
+
+# Latency percentile after which a duplicate (hedged) call is sent
+HEDGE_PERCENTILE = float(os.environ.get("RETAIL_HEDGE_PERCENTILE", 95))
+# Never hedge sooner than this many seconds into a call
+HEDGE_MIN_DELAY = float(os.environ.get("RETAIL_HEDGE_MIN_DELAY", 0.05))
+# Number of latency samples needed before hedging starts
+HEDGE_MIN_SAMPLES = int(os.environ.get("RETAIL_HEDGE_MIN_SAMPLES", 20))
+LATENCY_WINDOW = int(os.environ.get("RETAIL_LATENCY_WINDOW", 500))
+# Per-call timeout in seconds when the caller does not pass one
+CALL_TIMEOUT = float(os.environ.get("RETAIL_CALL_TIMEOUT", 5))
+# Consecutive failures that open the circuit breaker
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("RETAIL_BREAKER_FAILURE_THRESHOLD", 5))
+# Seconds the breaker stays open before letting a trial call through
+BREAKER_RESET_TIMEOUT = float(os.environ.get("RETAIL_BREAKER_RESET_TIMEOUT", 30))
+MAX_WORKERS = int(os.environ.get("RETAIL_MAX_WORKERS", 32))
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the Retail API circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after repeated failures.
+
+    The breaker opens after `failure_threshold` consecutive failures. Once
+    `reset_timeout` seconds have passed it lets a single trial call through;
+    success closes it again and failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def release(self):
+        """Ends a call that says nothing about backend health, such as one cut short by our own deadline."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"Retail API circuit breaker opened after {self.failures} failures")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+_search_client = None
+_product_client = None
+_clients_lock = threading.Lock()
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="retail")
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+_latencies = {
+    'search': metrics.Histogram(LATENCY_WINDOW),
+    'get_product': metrics.Histogram(LATENCY_WINDOW),
+}
+_stats = {
+    'calls': 0,
+    'failures': 0,
+    'timeouts': 0,
+    'deadline_exceeded': 0,
+    'queue_timeouts': 0,
+    'hedges_sent': 0,
+    'hedge_wins': 0,
+    'breaker_rejections': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def get_search_client() -> retail_v2.SearchServiceClient:
+    """Returns the shared search client, creating it on first use."""
+    global _search_client
+    if _search_client is None:
+        with _clients_lock:
+            if _search_client is None:
+                _search_client = retail_v2.SearchServiceClient()
+    return _search_client
+
+
+def get_product_client() -> retail_v2.ProductServiceClient:
+    """Returns the shared product client, creating it on first use."""
+    global _product_client
+    if _product_client is None:
+        with _clients_lock:
+            if _product_client is None:
+                _product_client = retail_v2.ProductServiceClient()
+    return _product_client
+
+
+def search(search_request: retail_v2.SearchRequest, timeout: float = None):
+    """Runs a search through the hedging and circuit-breaker layer."""
+    return _call('search', lambda t: get_search_client().search(request=search_request, timeout=t), timeout)
+
+
+def get_product(name: str, timeout: float = None) -> retail_v2.Product:
+    """Fetches a product through the hedging and circuit-breaker layer."""
+    get_request = retail_v2.GetProductRequest(name=name)
+    return _call('get_product', lambda t: get_product_client().get_product(request=get_request, timeout=t), timeout)
+
+
+def stats() -> dict:
+    """Returns hedge, timeout and breaker counters plus latency percentiles."""
+    with _stats_lock:
+        result = dict(_stats)
+    result['breaker_state'] = breaker.state
+    result['latency'] = {
+        kind: {
+            'samples': tracker.samples(),
+            'p50': tracker.percentile(50),
+            'p95': tracker.percentile(95),
+            'p99': tracker.percentile(99),
+        }
+        for kind, tracker in _latencies.items()
+    }
+    return result
+
+
+def _count(key: str):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def _hedge_delay(tracker: metrics.Histogram):
+    if tracker.samples() < HEDGE_MIN_SAMPLES:
+        return None
+    return max(HEDGE_MIN_DELAY, tracker.percentile(HEDGE_PERCENTILE))
+
+
+def _call(kind, fn, timeout):
+    with tracing.span(f"retail.{kind}") as span:
+        return _hedged_call(kind, fn, timeout, span)
+
+
+class _Attempt:
+    """One submission of a call; records when a pool thread actually starts it."""
+
+    def __init__(self, fn, timeout, request_deadline):
+        self.fn = fn
+        self.timeout = timeout
+        self.request_deadline = request_deadline
+        self.started = None
+
+    def run(self):
+        self.started = time.monotonic()
+        timeout = self.timeout
+        if self.request_deadline is not None:
+            timeout = min(timeout, self.request_deadline - self.started)
+            if timeout <= 0:
+                raise deadlines.DeadlineExceeded("Request deadline exceeded before the call started")
+        return self.fn(timeout)
+
+
+def _hedged_call(kind, fn, timeout, span):
+    """
+    Calls fn(timeout) with a deadline, hedging it once if it runs past the
+    configured latency percentile. fn is given the time left so the RPC
+    itself gives up when the caller does.
+
+    The backend is timed from when a pool thread starts the call, so time
+    spent queued behind other calls is not held against it. When the
+    current request's deadline runs out first, DeadlineExceeded is raised
+    and the circuit breaker is left alone; only calls that fail or time out
+    within the backend's own timeout count as failures.
+    """
+    timeout = CALL_TIMEOUT if timeout is None else timeout
+    # Raises DeadlineExceeded right away if the budget is already used up
+    deadlines.timeout(timeout)
+    left = deadlines.remaining()
+    request_deadline = None if left is None else time.monotonic() + left
+    span.set('timeout', timeout)
+    if not breaker.allow():
+        span.set('breaker', 'rejected')
+        _count('breaker_rejections')
+        raise CircuitOpenError("Retail API circuit breaker is open")
+    _count('calls')
+
+    tracker = _latencies[kind]
+    submitted = time.monotonic()
+    hedge_delay = _hedge_delay(tracker)
+
+    primary = _Attempt(fn, timeout, request_deadline)
+    attempts = {_executor.submit(primary.run): primary}
+    pending = set(attempts)
+    hedged = False
+    error = None
+    while pending:
+        now = time.monotonic()
+        # Queued calls get `timeout` to start; started ones `timeout` to finish
+        limit = (primary.started or submitted) + timeout
+        if request_deadline is not None:
+            limit = min(limit, request_deadline)
+        remaining = limit - now
+        if remaining <= 0:
+            break
+        wait_for = remaining
+        if not hedged and hedge_delay is not None:
+            if primary.started is None:
+                # Hedging while the pool is backed up would only add load
+                wait_for = min(remaining, HEDGE_MIN_DELAY)
+            else:
+                wait_for = min(remaining, max(0, primary.started + hedge_delay - now))
+        done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                tracker.observe(time.monotonic() - attempts[future].started)
+                breaker.record_success()
+                if future is not next(iter(attempts)):
+                    _count('hedge_wins')
+                    span.set('hedge_won', True)
+                return future.result()
+            error = future.exception()
+            if isinstance(error, ClientError):
+                # A 4xx such as NotFound means the backend is healthy
+                breaker.record_success()
+                raise error
+        if (pending and not done and not hedged and hedge_delay is not None
+                and primary.started is not None
+                and time.monotonic() >= primary.started + hedge_delay):
+            hedged = True
+            _count('hedges_sent')
+            span.set('hedged', True)
+            hedge = _Attempt(fn, max(0.001, primary.started + timeout - time.monotonic()), request_deadline)
+            future = _executor.submit(hedge.run)
+            attempts[future] = hedge
+            pending.add(future)
+
+    if error is not None and not pending and not isinstance(error, deadlines.DeadlineExceeded):
+        breaker.record_failure()
+        _count('failures')
+        raise error
+
+    if primary.started is None:
+        # Never left the queue: our pool is saturated, not the backend
+        breaker.release()
+        _count('queue_timeouts')
+        span.set('queued', True)
+        if request_deadline is not None and time.monotonic() >= request_deadline:
+            raise deadlines.DeadlineExceeded(f"Request deadline exceeded waiting to call Retail API {kind}")
+        raise TimeoutError(f"Retail API {kind} call did not start in time")
+
+    if request_deadline is not None and request_deadline < primary.started + timeout:
+        # Our own budget ran out before the backend's timeout did
+        breaker.release()
+        _count('deadline_exceeded')
+        span.set('deadline_exceeded', True)
+        raise deadlines.DeadlineExceeded(f"Request deadline exceeded during Retail API {kind} call")
+
+    breaker.record_failure()
+    _count('timeouts')
+    raise TimeoutError(f"Retail API {kind} call timed out")
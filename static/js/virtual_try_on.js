@@ -170,7 +170,8 @@ document.addEventListener('DOMContentLoaded', function() {
             },
             body: JSON.stringify({
                 person_image_gcs_uri: personImagePath,
-                apparel_gcs_uris: clothing_image_paths
+                apparel_gcs_uris: clothing_image_paths,
+                progressive: true
             }),
         })
         .then(response => response.json())
@@ -183,8 +184,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 resultsImageContainer.innerHTML = `
                     <div class="flex flex-col items-center">
                         <div class="flex flex-row justify-center gap-4 w-full">
-                            <div class="w-1/2">
-                                <img src="${data.image_url}" class="img-fluid w-full rounded-lg" alt="Virtual Try-On Result">
+                            <div class="w-1/2 relative">
+                                <img id="results-image" src="${data.image_url}" class="img-fluid w-full rounded-lg" alt="Virtual Try-On Result">
+                                ${data.refining ? '<p id="refining-label" class="absolute bottom-2 left-2 rounded bg-white/80 px-2 py-1 text-xs text-gray-600">Refining quality...</p>' : ''}
                             </div>
                             <div id="video-container" class="w-1/2 relative flex flex-col items-center justify-center bg-gray-200 rounded-lg">
                                 <div class="animate-spin inline-block w-8 h-8 border-4 rounded-full border-gray-400 border-t-transparent" role="status"></div>
@@ -201,6 +203,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 `;
                 resultsContainer.style.display = 'block';
                 setVideoContainerHeight();
+                if (data.refining) {
+                    pollForRefinedImage(data.generation_id);
+                }
                 // Only poll for the video if it's not already there
                 if (!document.querySelector('#video-container video')) {
                     pollForVideo(data.generation_id);
@@ -216,6 +221,35 @@ document.addEventListener('DOMContentLoaded', function() {
             alert('Error sending virtual try-on request.');
         });
         
+        function pollForRefinedImage(generationId) {
+            const interval = setInterval(() => {
+                fetch(`/api/poll-refine/${encodeURIComponent(generationId)}`)
+                    .then(response => response.json())
+                    .then(data => {
+                        if (data.status === 'processing') {
+                            return;
+                        }
+                        clearInterval(interval);
+                        const refiningLabel = document.getElementById('refining-label');
+                        if (refiningLabel) {
+                            refiningLabel.remove();
+                        }
+                        if (data.status === 'done') {
+                            // Swap in the full-quality image once it has loaded
+                            const refined = new Image();
+                            refined.onload = () => {
+                                document.getElementById('results-image').src = data.image_url;
+                            };
+                            refined.src = data.image_url;
+                        }
+                    })
+                    .catch(error => {
+                        console.error('Error polling for refined image:', error);
+                        clearInterval(interval);
+                    });
+            }, 2000); // Poll every 2 seconds
+        }
+
         function pollForVideo(generationId) {
             const interval = setInterval(() => {
                 fetch(`/api/poll-video/${encodeURIComponent(generationId)}`)
@@ -0,0 +1,238 @@
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+# Finished spans are appended here as JSON lines
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+# The trace file is rotated to TRACE_FILE.1 once it grows past this size
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024))
+# Number of recent spans kept in memory for the debug page
+RECENT_SPANS = int(os.environ.get("TRACE_RECENT_SPANS", 5000))
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() != "false"
+# Spans waiting for the writer thread; spans are dropped rather than block callers
+EXPORT_QUEUE_SIZE = int(os.environ.get("TRACE_EXPORT_QUEUE_SIZE", 10000))
+# Most spans the writer appends per file open
+EXPORT_BATCH_SIZE = 500
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+_recent = deque(maxlen=RECENT_SPANS)
+_recent_lock = threading.Lock()
+
+_export_queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+_dropped = 0
+
+
+class Span:
+    """A timed operation within a trace."""
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self._start_monotonic = time.monotonic()
+        self.duration = None
+        self.error = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.duration = time.monotonic() - self._start_monotonic
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'thread': self.thread,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class _NoopSpan:
+    def set(self, key, value):
+        pass
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_span(name: str, **attributes):
+    """
+    Starts a span as a child of the current one and makes it current.
+
+    Returns (span, token); pass both to finish_span(). Use span() instead
+    unless the start and end happen in different callbacks. With tracing
+    disabled, returns a no-op span that finish_span() ignores.
+    """
+    if not TRACING_ENABLED:
+        return _NoopSpan(), None
+    span = Span(name, _current_span.get(), attributes)
+    return span, _current_span.set(span)
+
+
+def finish_span(span: Span, token, error: BaseException = None):
+    if token is None:
+        return
+    if error is not None:
+        span.error = repr(error)
+    span.end()
+    _current_span.reset(token)
+    _export(span)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Times the enclosed block as a child of the current span."""
+    current, token = start_span(name, **attributes)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_span(current, token, error)
+
+
+def traced(name: str = None):
+    """Decorates a function so each call is recorded as a span."""
+    def decorator(fn):
+        span_name = name or f"{fn.__module__}.{fn.__name__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(fn):
+    """
+    Wraps fn so spans it creates are children of the caller's current span,
+    for background threads that should not inherit anything else (such as
+    the request deadline).
+    """
+    parent = _current_span.get()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+    return wrapper
+
+
+def recent_traces(limit: int = 20) -> list:
+    """
+    Returns the most recent traces, newest first, laid out as waterfalls.
+
+    Each trace is a dict with the root span's name, start and duration and
+    a list of spans in start order, each with its offset from the trace
+    start and nesting depth.
+    """
+    with _recent_lock:
+        spans = list(_recent)
+
+    # Root spans finish last, so walking backwards orders traces newest first
+    traces = OrderedDict()
+    for s in reversed(spans):
+        traces.setdefault(s['trace_id'], []).append(s)
+
+    result = []
+    for trace_id, trace_spans in list(traces.items())[:limit]:
+        trace_spans.sort(key=lambda s: s['start'])
+        by_id = {s['span_id']: s for s in trace_spans}
+        root = next((s for s in trace_spans if s['parent_id'] is None), trace_spans[0])
+        start = trace_spans[0]['start']
+        end = max(s['start'] + (s['duration'] or 0) for s in trace_spans)
+        total = max(end - start, 1e-6)
+
+        rows = []
+        for s in trace_spans:
+            depth = 0
+            parent = by_id.get(s['parent_id'])
+            while parent is not None and depth < 20:
+                depth += 1
+                parent = by_id.get(parent['parent_id'])
+            rows.append(dict(
+                s,
+                offset=s['start'] - start,
+                depth=depth,
+                left_pct=100 * (s['start'] - start) / total,
+                width_pct=max(0.5, 100 * (s['duration'] or 0) / total),
+            ))
+        result.append({
+            'trace_id': trace_id,
+            'name': root['name'],
+            'start': start,
+            'duration': end - start,
+            'spans': rows,
+        })
+    return result
+
+
+def _export(span: Span):
+    global _dropped
+    record = span.to_dict()
+    with _recent_lock:
+        _recent.append(record)
+    _ensure_writer()
+    try:
+        _export_queue.put_nowait(record)
+    except queue.Full:
+        _dropped += 1
+
+
+def _ensure_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_spans, name="trace-writer", daemon=True)
+            _writer.start()
+
+
+def _write_spans():
+    global _dropped
+    while True:
+        records = [_export_queue.get()]
+        while len(records) < EXPORT_BATCH_SIZE:
+            try:
+                records.append(_export_queue.get_nowait())
+            except queue.Empty:
+                break
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        try:
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+                os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+            with open(TRACE_FILE, 'a') as f:
+                f.write(lines)
+        except OSError as e:
+            print(f"Could not write {len(records)} trace spans: {e}")
+        if _dropped:
+            print(f"Trace export queue full, dropped {_dropped} spans")
+            _dropped = 0
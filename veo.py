@@ -1,8 +1,36 @@
+import json
 import os
+import threading
 import time
+from concurrent.futures import Future
 from google import genai
-from google.cloud import storage
-from google.genai.types import Image, GenerateVideosConfig
+from google.api_core.exceptions import NotFound
+from google.genai.types import Image, GenerateVideosConfig, GetOperationConfig
+
+import deadlines
+import gcs
+import tracing
+
+# Configure the Gemini client for Vertex AI
+PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
+LOCATION = os.environ.get("GOOGLE_CLOUD_REGION", "us-central1")
+client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
+
+# Longest a whole video generation may take before the thread gives up
+VEO_TIMEOUT = float(os.environ.get("VEO_TIMEOUT", 600))
+# Longest a single Veo API request may take
+VEO_REQUEST_TIMEOUT = float(os.environ.get("VEO_REQUEST_TIMEOUT", 60))
+
+# image content hash -> public URL of the video generated from it
+_videos = {}
+# image content hash -> Future for a generation that is currently running
+_inflight = {}
+_lock = threading.Lock()
+
+
+def _public_url(gcs_uri: str) -> str:
+    return f"https://storage.googleapis.com/{gcs_uri[5:]}"
+
 
 def generate_video_from_gcs(gcs_uri: str, output_gcs_uri: str) -> str:
     """
@@ -16,52 +44,116 @@ def generate_video_from_gcs(gcs_uri: str, output_gcs_uri: str) -> str:
         The public URL of the generated video.
     """
     try:
-        # Configure the Gemini client for Vertex AI
-        PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
-        LOCATION = os.environ.get("GOOGLE_CLOUD_REGION", "us-central1")
-        client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
-
-        # Generate the video
-        operation = client.models.generate_videos(
-            model="veo-2.0-generate-001",
-            prompt="A model twirling around, showcasing the outfit.",
-            image=Image(
-                gcs_uri=gcs_uri,
-                mime_type="image/png",
-            ),
-            config=GenerateVideosConfig(
-                aspect_ratio="9:16", # Portrait aspect ratio for model
-                output_gcs_uri=output_gcs_uri,
-                generate_audio=False,
-            ),
+        with deadlines.deadline(VEO_TIMEOUT):
+            return _run_generation(gcs_uri, output_gcs_uri)
+    except Exception as e:
+        print(f"Error generating video: {e}")
+        raise
+
+
+@tracing.traced("veo.generate_videos")
+def _run_generation(gcs_uri: str, output_gcs_uri: str) -> str:
+    # Generate the video
+    operation = client.models.generate_videos(
+        model="veo-2.0-generate-001",
+        prompt="A model twirling around, showcasing the outfit.",
+        image=Image(
+            gcs_uri=gcs_uri,
+            mime_type="image/png",
+        ),
+        config=GenerateVideosConfig(
+            aspect_ratio="9:16", # Portrait aspect ratio for model
+            output_gcs_uri=output_gcs_uri,
+            generate_audio=False,
+            http_options=deadlines.http_options(VEO_REQUEST_TIMEOUT),
+        ),
+    )
+
+    print("Waiting for video generation operation to complete...")
+
+    while not operation.done:
+        # Raises DeadlineExceeded once VEO_TIMEOUT has passed
+        time.sleep(min(15, deadlines.timeout(15)))
+        operation = client.operations.get(
+            operation,
+            config=GetOperationConfig(http_options=deadlines.http_options(VEO_REQUEST_TIMEOUT)),
         )
-        
-        print("Waiting for video generation operation to complete...")
-
-        while not operation.done:
-            time.sleep(15)
-            operation = client.operations.get(operation)
-            print(operation)
-
-        if operation.response:
-            # The video is at output_gcs_uri + a generated filename.
-            # We need to find the generated video file in the output directory.
-            storage_client = storage.Client()
-            bucket_name = output_gcs_uri.split('/')[2]
-            prefix = '/'.join(output_gcs_uri.split('/')[3:])
-            bucket = storage_client.bucket(bucket_name)
-            blobs = bucket.list_blobs(prefix=prefix)
-            
-            # Find the first video file in the output directory
-            for blob in blobs:
-                if blob.name.endswith('.mp4'):
-                    return blob.public_url
-            
-            # If no video is found, raise an exception
-            raise Exception("Generated video not found in output directory.")
-        else:
-            raise Exception(f"Video generation failed: {operation.error}")
 
+    if operation.response and operation.response.generated_videos:
+        # The operation reports where it wrote the video, so no listing is needed
+        video = operation.response.generated_videos[0].video
+        if video and video.uri:
+            return _public_url(video.uri)
+        raise Exception("Video generation finished without an output URI.")
+    else:
+        raise Exception(f"Video generation failed: {operation.error}")
+
+
+@tracing.traced("veo.generate_video_for_image")
+def generate_video_for_image(gcs_uri: str, image_hash: str) -> str:
+    """
+    Returns a video for the image, generating one only if none exists yet.
+
+    Videos are memoized on the image's content hash, both in memory and as a
+    small pointer blob in GCS that survives restarts. Concurrent calls for the
+    same image wait on the generation that is already running.
+
+    Args:
+        gcs_uri: The GCS URI of the image to use as input.
+        image_hash: The content hash of the image bytes.
+
+    Returns:
+        The public URL of the video.
+    """
+    with _lock:
+        if image_hash in _videos:
+            return _videos[image_hash]
+        future = _inflight.get(image_hash)
+        owner = future is None
+        if owner:
+            future = Future()
+            _inflight[image_hash] = future
+
+    if not owner:
+        return future.result()
+
+    try:
+        video_url = _lookup_video(image_hash)
+        generated = video_url is None
+        if generated:
+            video_url = generate_video_from_gcs(gcs_uri, gcs.gs_uri(f"veo/{image_hash}/"))
+        with _lock:
+            _videos[image_hash] = video_url
+        future.set_result(video_url)
     except Exception as e:
-        print(f"Error generating video: {e}")
-        raise
\ No newline at end of file
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(image_hash, None)
+
+    # The video is already memoized here; the pointer only helps after a restart
+    if generated:
+        try:
+            _record_video(image_hash, video_url)
+        except Exception as e:
+            print(f"Could not record video pointer for {image_hash}: {e}")
+    return video_url
+
+
+def _pointer_blob_name(image_hash: str) -> str:
+    return f"veo/{image_hash}.json"
+
+
+def _lookup_video(image_hash: str):
+    try:
+        blob = gcs.get_bucket().blob(_pointer_blob_name(image_hash))
+        data = blob.download_as_text(timeout=gcs.REQUEST_TIMEOUT)
+    except NotFound:
+        return None
+    return json.loads(data).get('url')
+
+
+def _record_video(image_hash: str, video_url: str):
+    pointer = json.dumps({'url': video_url}).encode("utf-8")
+    gcs.upload_bytes(_pointer_blob_name(image_hash), pointer, content_type='application/json')
@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from google.api_core.exceptions import NotFound
+
+import deadlines
+import gcs
+
+# Number of try-on results kept in memory; GCS pointers back the rest
+MEMORY_ENTRIES = int(os.environ.get("VTO_CACHE_MEMORY_ENTRIES", 1024))
+# Seconds a miss is remembered before GCS is asked again
+MISS_TTL = float(os.environ.get("VTO_CACHE_MISS_TTL", 60))
+POINTER_PREFIX = "vto_cache"
+
+_entries = OrderedDict()
+# key -> monotonic time the miss was seen
+_misses = OrderedDict()
+_lock = threading.Lock()
+
+
+def cache_key(person_image_uri: str, clothing_image_uris: list, quality: str) -> str:
+    """Returns the cache key for a try-on of these exact inputs."""
+    return gcs.inputs_hash("vto", quality, person_image_uri, *clothing_image_uris)
+
+
+def get(key: str):
+    """
+    Returns the cached result for a key, or None.
+
+    A result is a dict with the try-on image's 'blob_name' and 'image_hash'.
+    Misses are remembered for MISS_TTL seconds, and GCS errors count as
+    misses, so a lookup never fails a try-on.
+    """
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            return _entries[key]
+        missed_at = _misses.get(key)
+        if missed_at is not None and time.monotonic() - missed_at < MISS_TTL:
+            return None
+
+    try:
+        blob = gcs.get_bucket().blob(_pointer_blob_name(key))
+        result = json.loads(blob.download_as_text(timeout=deadlines.timeout(gcs.REQUEST_TIMEOUT)))
+    except deadlines.DeadlineExceeded:
+        raise
+    except NotFound:
+        _remember_miss(key)
+        return None
+    except Exception as e:
+        print(f"Could not read try-on cache entry {key}: {e}")
+        return None
+    _remember(key, result)
+    return result
+
+
+def put(key: str, blob_name: str, image_hash: str):
+    """
+    Caches a try-on result in memory, and as a pointer blob in GCS once the
+    result image itself has landed, so a pointer never names a missing blob.
+    """
+    result = {'blob_name': blob_name, 'image_hash': image_hash}
+    _remember(key, result)
+    pointer = json.dumps(result).encode("utf-8")
+    gcs.on_uploaded(
+        blob_name,
+        lambda: gcs.upload_bytes(_pointer_blob_name(key), pointer, content_type='application/json'),
+    )
+
+
+def _remember(key, result):
+    with _lock:
+        _misses.pop(key, None)
+        _entries[key] = result
+        _entries.move_to_end(key)
+        while len(_entries) > MEMORY_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def _remember_miss(key):
+    with _lock:
+        _misses[key] = time.monotonic()
+        _misses.move_to_end(key)
+        while len(_misses) > MEMORY_ENTRIES:
+            _misses.popitem(last=False)
+
+
+def _pointer_blob_name(key: str) -> str:
+    return f"{POINTER_PREFIX}/{key}.json"
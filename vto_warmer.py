@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+import deadlines
+import gcs
+import tracing
+
+VTO_WARMER_ENABLED = os.environ.get("VTO_WARMER_ENABLED", "true").lower() != "false"
+# Seconds between checks of the featured products and house model set
+CHECK_INTERVAL = float(os.environ.get("VTO_WARMER_CHECK_INTERVAL", 60))
+# Seconds to pause after each rendered combination, capping warmer throughput
+ITEM_PAUSE = float(os.environ.get("VTO_WARMER_ITEM_PAUSE", 30))
+# Time budget for rendering a single combination
+ITEM_BUDGET = float(os.environ.get("VTO_WARMER_ITEM_BUDGET", 120))
+# Seconds to wait before re-checking while live try-ons are running
+BUSY_BACKOFF = float(os.environ.get("VTO_WARMER_BUSY_BACKOFF", 2))
+
+_thread = None
+_thread_lock = threading.Lock()
+_status = {
+    'fingerprint': None,
+    'combinations': 0,
+    'rendered': 0,
+    'cached': 0,
+    'failed': 0,
+    'last_run': None,
+}
+
+
+def start(warm_one, combinations, is_busy):
+    """
+    Starts the background warmer thread, once per process.
+
+    Args:
+        warm_one: Called as warm_one(person_image_uri, clothing_image_uris);
+            renders the try-on into the result cache and returns True, or
+            returns False if the result was already cached.
+        combinations: Returns the (person_image_uri, clothing_image_uris)
+            pairs to keep warm. It is re-read every CHECK_INTERVAL seconds
+            and the set is re-warmed whenever it changes.
+        is_busy: Returns True while live try-ons are running; the warmer
+            waits for it to return False before each render.
+    """
+    global _thread
+    if not VTO_WARMER_ENABLED:
+        return
+    with _thread_lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(
+            target=_run, args=(warm_one, combinations, is_busy), name="vto-warmer", daemon=True
+        )
+        _thread.start()
+
+
+def status() -> dict:
+    return dict(_status)
+
+
+def _run(warm_one, combinations, is_busy):
+    while True:
+        try:
+            pairs = combinations()
+            fingerprint = gcs.inputs_hash(*(f"{person}|{','.join(clothing)}" for person, clothing in pairs))
+            if fingerprint != _status['fingerprint']:
+                _status['combinations'] = len(pairs)
+                complete = _warm(pairs, warm_one, is_busy)
+                _status['last_run'] = time.time()
+                # Failed combinations are retried on the next check
+                if complete:
+                    _status['fingerprint'] = fingerprint
+        except Exception as e:
+            print(f"VTO warmer run failed: {e}")
+        time.sleep(CHECK_INTERVAL)
+
+
+def _warm(pairs, warm_one, is_busy):
+    """Warms every pair; returns True if all of them are now cached."""
+    complete = True
+    for person_image_uri, clothing_image_uris in pairs:
+        # Live traffic always goes first
+        while is_busy():
+            time.sleep(BUSY_BACKOFF)
+        try:
+            with deadlines.deadline(ITEM_BUDGET), tracing.span("vto_warmer.warm", person=person_image_uri):
+                rendered = warm_one(person_image_uri, clothing_image_uris)
+        except Exception as e:
+            print(f"VTO warmer could not render {person_image_uri} with {clothing_image_uris}: {e}")
+            _status['failed'] += 1
+            complete = False
+            rendered = True
+        else:
+            _status['rendered' if rendered else 'cached'] += 1
+        if rendered:
+            time.sleep(ITEM_PAUSE)
+    return complete
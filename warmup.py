@@ -0,0 +1,63 @@
+import os
+import threading
+import time
+
+import deadlines
+import tracing
+
+# Time budget for the whole warm-up; steps still running past it fail fast
+WARMUP_BUDGET = float(os.environ.get("WARMUP_BUDGET", 60))
+
+_ready = threading.Event()
+_thread = None
+_thread_lock = threading.Lock()
+_status = {
+    'state': 'pending',
+    'started': None,
+    'finished': None,
+    'steps': {},
+}
+
+
+def start(steps):
+    """
+    Runs the warm-up steps in a background thread, once per process.
+
+    Args:
+        steps: A list of (name, fn) pairs, run in order. A failing step is
+            logged and recorded, and the remaining steps still run; the
+            process is marked ready once every step has been attempted.
+    """
+    global _thread
+    with _thread_lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_run, args=(steps,), name="warmup", daemon=True)
+        _thread.start()
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def status() -> dict:
+    return dict(_status, steps=dict(_status['steps']))
+
+
+def _run(steps):
+    _status['state'] = 'warming'
+    _status['started'] = time.time()
+    with deadlines.deadline(WARMUP_BUDGET), tracing.span("warmup"):
+        for name, fn in steps:
+            started = time.monotonic()
+            try:
+                with tracing.span(f"warmup.{name}"):
+                    fn()
+            except Exception as e:
+                print(f"Warm-up step {name} failed: {e}")
+                _status['steps'][name] = {'ok': False, 'seconds': time.monotonic() - started, 'error': str(e)}
+            else:
+                _status['steps'][name] = {'ok': True, 'seconds': time.monotonic() - started}
+    _status['state'] = 'ready'
+    _status['finished'] = time.time()
+    _ready.set()